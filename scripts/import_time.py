@@ -0,0 +1,63 @@
+"""
+Import-time benchmark: measures cold import of the modules needed to start a bm25-only instance and checks
+that heavy backends are not imported with them. Exits with code 1 if the time budget is exceeded or a heavy
+module is imported, so it can be used as a regression check:
+
+    python scripts/import_time.py --budget 1.0
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+HOME_PATH = Path(__file__).resolve().parent.parent
+
+MODULES = ['thesis_search.search_models.search_engine', 'thesis_search.search_models.engine_pool']
+HEAVY_MODULES = ['spacy', 'torch', 'transformers', 'gensim', 'fasttext', 'sklearn']
+
+PROBE = '''
+import sys, time
+start = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+
+def measure(modules, heavy_modules):
+    """
+    Imports modules in a fresh interpreter
+    Returns: import time in seconds, heavy modules that were imported
+    """
+    code = PROBE.format(imports='\n'.join(f'import {m}' for m in modules), heavy=heavy_modules)
+    output = subprocess.run([sys.executable, '-c', code], cwd=HOME_PATH, capture_output=True, text=True, check=True)
+    elapsed, imported = (output.stdout.splitlines() + [''])[:2]
+    return float(elapsed), imported.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=1.0, help='maximum import time in seconds')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs (the best one is reported)')
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='modules to import')
+    args = parser.parse_args()
+
+    runs = [measure(args.modules, HEAVY_MODULES) for _ in range(args.repeat)]
+    best = min(elapsed for elapsed, _ in runs)
+    imported = sorted({m for _, heavy in runs for m in heavy})
+
+    print(f'import time: best {best:.3f} s, worst {max(elapsed for elapsed, _ in runs):.3f} s '
+          f'(budget {args.budget:.3f} s)')
+    failed = False
+    if imported:
+        print(f'heavy modules imported: {", ".join(imported)}')
+        failed = True
+    if best > args.budget:
+        print('import time budget exceeded')
+        failed = True
+    sys.exit(int(failed))
+
+
+if __name__ == '__main__':
+    main()
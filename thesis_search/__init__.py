@@ -19,6 +19,10 @@ LM_FOLDER = config['folders']['lm_folder']
 
 INDEX_TYPES = {k: v for k, v in config['models'].items()}
 
+CACHE_SETTINGS = config.get('cache', {})
+WEBUI_SETTINGS = config.get('webui', {})
+DAEMON_SETTINGS = {'host': '127.0.0.1', 'port': 8765, **config.get('daemon', {})}
+
 MODEL_DEFAULTS = config['defaults']
 for m in ['w2v', 'ft']:
     if not Path(MODEL_DEFAULTS[m]['model_path']).is_absolute():
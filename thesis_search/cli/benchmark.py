@@ -0,0 +1,157 @@
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_QUERIES = [
+    'векторное представление многозначных слов',
+    'машинный перевод',
+    'автоматическое определение тональности текста',
+    'корпус русского языка',
+    'распознавание именованных сущностей',
+    'морфологический анализ',
+    'языковые модели для классификации текстов',
+    'фонетика и просодия',
+]
+
+TIME_COLUMNS = ['implementation', 'cold_start', 'p50_ms', 'p95_ms', 'p99_ms', 'qps']
+MEMORY_COLUMNS = ['rss', 'peak_rss']
+HIGHER_IS_WORSE = ['cold_start', 'p50_ms', 'p95_ms', 'p99_ms', 'rss', 'peak_rss']
+LOWER_IS_WORSE = ['qps']
+
+
+def resident_memory() -> Optional[int]:
+    """
+    Current resident set size of the process in bytes (None if it can't be read on this platform)
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_resident_memory() -> Optional[int]:
+    """
+    Peak resident set size of the process in bytes (None if it can't be read on this platform)
+    """
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # на linux в килобайтах
+
+
+def benchmark_index(idx_type: str, queries: List[str], n: int, repeat: int) -> Dict[str, Any]:
+    """
+    Measures one index type, should be run in a fresh process, so that cold start includes imports and loading of
+    the models and memory belongs to this index only
+    Args:
+        idx_type: index type from config
+        queries: search queries
+        n: number of documents in the result
+        repeat: number of passes over the queries
+
+    Returns: {'implementation', 'cold_start' (s), 'p50_ms', 'p95_ms', 'p99_ms', 'qps', 'rss', 'peak_rss' (bytes)}
+    """
+    start = time.perf_counter()
+    from .. import DATA_FOLDER, INDEX_FOLDER, MODEL_DEFAULTS
+    from ..utils.cache import ResultCache
+    from ..utils.database import DBHandler
+    from ..search_models.search_engine import SearchEngine, QueryError
+
+    SearchEngine.result_cache = ResultCache(maxsize=0)  # каждый запрос должен доходить до индекса
+    defaults = MODEL_DEFAULTS[idx_type]
+    engine = SearchEngine(
+        index_type=idx_type,
+        implementation=defaults['implementation'],
+        index_folder=INDEX_FOLDER,
+        data_retriever=DBHandler(Path(DATA_FOLDER, 'theses.db')),
+        defaults=defaults,
+        preprocessor=defaults['preprocessor_']
+    )
+
+    def timed_search(query: str) -> float:
+        query_start = time.perf_counter()
+        try:
+            engine.search(query, n)
+        except QueryError:
+            pass
+        return time.perf_counter() - query_start
+
+    timed_search(queries[0])  # первый запрос загружает spacy и токенизаторы
+    cold_start = time.perf_counter() - start
+    rss = resident_memory()
+
+    latencies = np.array([timed_search(query) for _ in range(repeat) for query in queries])
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        'implementation': defaults['implementation'],
+        'cold_start': cold_start,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'qps': len(latencies) / latencies.sum(),
+        'rss': rss,
+        'peak_rss': peak_resident_memory()
+    }
+
+
+def run_benchmark(idx_types: List[str], queries: List[str], n: int, repeat: int) -> pd.DataFrame:
+    """
+    Benchmarks every index type in its own process (one after another, so they don't compete for cpu)
+    Returns: table with one row per index type and columns TIME_COLUMNS + MEMORY_COLUMNS
+    """
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for idx_type in idx_types:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[idx_type] = executor.submit(benchmark_index, idx_type, queries, n, repeat).result()
+    return pd.DataFrame.from_dict(results, orient='index')[TIME_COLUMNS + MEMORY_COLUMNS]
+
+
+def save_statistics(stats: pd.DataFrame, folder: Path):
+    """
+    Writes time_statistics.csv and memory_statistics.csv (the files shown by the stats command)
+    """
+    folder.mkdir(parents=True, exist_ok=True)
+    stats[TIME_COLUMNS].to_csv(Path(folder, 'time_statistics.csv'))
+    stats[MEMORY_COLUMNS].to_csv(Path(folder, 'memory_statistics.csv'))
+
+
+def load_statistics(folder: Path) -> pd.DataFrame:
+    time_stats = pd.read_csv(Path(folder, 'time_statistics.csv'), header=0, index_col=0)
+    memory_stats = pd.read_csv(Path(folder, 'memory_statistics.csv'), header=0, index_col=0)
+    return time_stats.join(memory_stats)
+
+
+def compare_with_baseline(stats: pd.DataFrame, baseline: pd.DataFrame, tolerance: float) -> List[str]:
+    """
+    Finds metrics that got worse than in the baseline by more than tolerance
+    (index types and metrics that are missing in the baseline are not compared)
+    Args:
+        stats: current statistics
+        baseline: statistics of the previous run
+        tolerance: allowed relative change, for ex. 0.2 - 20%
+
+    Returns: descriptions of regressions
+    """
+    regressions = []
+    for idx_type in stats.index.intersection(baseline.index):
+        for metric in HIGHER_IS_WORSE + LOWER_IS_WORSE:
+            if metric not in baseline.columns:
+                continue
+            old, new = baseline.at[idx_type, metric], stats.at[idx_type, metric]
+            if pd.isna(old) or pd.isna(new) or not old:
+                continue
+            change = (new - old) / old
+            if (metric in HIGHER_IS_WORSE and change > tolerance) or (metric in LOWER_IS_WORSE and -change > tolerance):
+                regressions.append(f'{idx_type} {metric}: {old:.4g} -> {new:.4g} ({change:+.0%})')
+    return regressions
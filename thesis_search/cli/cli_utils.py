@@ -1,11 +1,14 @@
-from typing import Tuple, Dict, Any, Iterable
+from typing import Tuple, Dict, Any, Iterable, TYPE_CHECKING
 from pathlib import Path
 
 import yaml
-import pandas as pd
 from rich.table import Table
 
 from .. import HOME_PATH
+from ..utils.metrics import format_timings
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def pretty_table(result: Tuple[str, int, str, str, str, str, str]) -> Table:
@@ -16,6 +19,13 @@ def pretty_table(result: Tuple[str, int, str, str, str, str, str]) -> Table:
     return table
 
 
+def timings_table(timings: Dict[str, float]) -> Table:
+    table = Table('этап', 'время', title='Время этапов поиска (tokenize и forward входят в vectorize)')
+    for stage, stage_time in format_timings(timings):
+        table.add_row(stage, stage_time)
+    return table
+
+
 def table_config(configs: Dict[str, dict], project_models: Iterable[str]):
     tables = []
     for model in project_models:
@@ -27,7 +37,7 @@ def table_config(configs: Dict[str, dict], project_models: Iterable[str]):
     return tables
 
 
-def pandas_to_rich_table(df: pd.DataFrame):
+def pandas_to_rich_table(df: 'pd.DataFrame'):
     df = df.astype(str)
     table = Table('', *df.columns.tolist())
     for index, row in df.iterrows():
@@ -0,0 +1,117 @@
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Optional, Dict, Any
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.request import urlopen
+
+
+class DaemonError(Exception):
+    pass
+
+
+def make_handler(search_engines):
+    """
+    Creates request handler that serves queries with engines from the pool
+    Args:
+        search_engines: EnginePool with engines that are kept in memory
+    """
+    from ..search_models.search_engine import QueryError
+
+    class SearchHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query_params = parse_qs(url.query)
+            params = {k: v[0] for k, v in query_params.items()}
+            filters = {field: query_params[field] for field in ('year', 'program', 'supervisor')
+                       if field in query_params}
+            if url.path == '/status':
+                return self.send_json(200, {'engines': search_engines.status()})
+            if url.path != '/search':
+                return self.send_json(404, {'error': f'Unknown path: {url.path}'})
+            idx_type = params.get('idx_type', 'bm25')
+            if idx_type not in search_engines.index_types:
+                return self.send_json(400, {'error': f'Index type can be only one of those '
+                                                     f'{search_engines.index_types}'})
+            timings = {}
+            try:
+                results = search_engines.get(idx_type).search(params.get('query', ''), int(params.get('n', 1)),
+                                                              filters, timings)
+            except (QueryError, ValueError) as e:
+                return self.send_json(400, {'error': str(e)})
+            except Exception as e:
+                return self.send_json(500, {'error': repr(e)})
+            self.send_json(200, {'results': results, 'timings': timings})
+
+        def log_message(self, format, *args):  # не печатать каждый запрос
+            pass
+
+    return SearchHandler
+
+
+def serve(search_engines, host: str, port: int):
+    """
+    Serves search queries on localhost until interrupted
+    Args:
+        search_engines: EnginePool with engines that are kept in memory
+        host: address to bind (should be local)
+        port: port to bind
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(search_engines))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def remote_search(query: str, idx_type: str, n: int, host: str, port: int,
+                  timeout: float = 600, filters: Dict[str, List[Any]] = None,
+                  timings: Dict[str, float] = None) -> Optional[List[list]]:
+    """
+    Sends query to the running daemon
+    Args:
+        query: search query
+        idx_type: index type
+        n: number of documents in the result
+        host: daemon address
+        port: daemon port
+        timeout: seconds to wait for the answer (the daemon may be loading the engine)
+        filters: {field: list of values} - search only theses with these metadata
+        timings: if given, is filled with durations of search stages measured by the daemon
+
+    Returns: search results or None if the daemon is not running (can't connect to it)
+    Raises: DaemonError if the daemon returned an error or the answer is not a valid response of the daemon
+    """
+    params = [('query', query), ('idx_type', idx_type), ('n', n)]
+    params += [(field, value) for field, values in (filters or {}).items() for value in values or []]
+    url = f'http://{host}:{port}/search?' + urlencode(params)
+    try:
+        with urlopen(url, timeout=timeout) as response:
+            body = response.read()
+    except HTTPError as e:
+        try:
+            message = json.load(e)['error']
+        except (ValueError, KeyError, TypeError):  # на этом порту работает что-то другое
+            message = f'Unexpected answer from {host}:{port}: HTTP {e.code}'
+        raise DaemonError(message) from e
+    except (URLError, ConnectionError):  # демон не запущен, поиск выполняется в этом процессе
+        return None
+    try:
+        answer = json.loads(body)
+        results = answer['results']
+        if timings is not None:
+            timings.update(answer.get('timings', {}))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise DaemonError(f'Malformed answer from {host}:{port}: {e!r}') from e
+    return results
@@ -1,15 +1,14 @@
 from pathlib import Path
 from typing import List
 
-import pandas as pd
 import typer
 from rich.console import Console
 
-from .. import DATA_FOLDER, INDEX_TYPES, MODEL_DEFAULTS, INDEX_FOLDER
-from ..search_models.search_engine import SearchEngine
-from ..utils.utils import pprint_result
+from .. import DATA_FOLDER, INDEX_TYPES, MODEL_DEFAULTS, INDEX_FOLDER, DAEMON_SETTINGS
+from ..utils.utils import pprint_result, lemmatize_corpus, load_nlp, crawl_corpus
 from ..utils.database import DBHandler
-from .cli_utils import pretty_table, table_config, pandas_to_rich_table, change_config, remove_index_from_config, add_index_to_config
+from .daemon import serve as serve_daemon, remote_search
+from .cli_utils import pretty_table, timings_table, table_config, pandas_to_rich_table, change_config, remove_index_from_config, add_index_to_config
 
 app = typer.Typer()
 console = Console()
@@ -30,24 +29,52 @@ def search(query: str,
            style: str = typer.Option(
                default='text',
                help='Output style: plain text or table'
+           ),
+           year: List[int] = typer.Option(
+               default=None,
+               help='Search only theses of this year (can be repeated)'
+           ),
+           program: List[str] = typer.Option(
+               default=None,
+               help='Search only theses of this educational program (can be repeated)'
+           ),
+           supervisor: List[str] = typer.Option(
+               default=None,
+               help='Search only theses of this supervisor (can be repeated)'
+           ),
+           use_daemon: bool = typer.Option(
+               default=True,
+               help='Send the query to the running search daemon (see serve command) if there is one'
+           ),
+           profile: bool = typer.Option(
+               default=False,
+               help='Show time of every search stage (spacy, vectorization, scoring, top-k, database)'
            )):
 
     if idx_type not in INDEX_TYPES:
         raise ValueError(f'Index type can be only one of those {list(INDEX_TYPES.keys())}')
 
-    try:
-        search_engine = SearchEngine(
-            index_type=idx_type,
-            implementation=MODEL_DEFAULTS[idx_type]['implementation'],
-            index_folder=INDEX_FOLDER,
-            data_retriever=db,
-            defaults=MODEL_DEFAULTS[idx_type],
-            preprocessor=MODEL_DEFAULTS[idx_type]['preprocessor_']
-        )
-    except FileNotFoundError:
-        raise FileNotFoundError(f'Модель для этого способа индексации еще не скачена. Запустите команду '
-                                f'"python -m thesis_search download {idx_type}", а потом попробуйте еще раз')
-    results = search_engine.search(query, n)
+    filters = {'year': year, 'program': program, 'supervisor': supervisor}
+    results = None
+    timings = {}
+    if use_daemon:
+        results = remote_search(query, idx_type, n, DAEMON_SETTINGS['host'], DAEMON_SETTINGS['port'],
+                                filters=filters, timings=timings)
+    if results is None:
+        from ..search_models.search_engine import SearchEngine
+        try:
+            search_engine = SearchEngine(
+                index_type=idx_type,
+                implementation=MODEL_DEFAULTS[idx_type]['implementation'],
+                index_folder=INDEX_FOLDER,
+                data_retriever=db,
+                defaults=MODEL_DEFAULTS[idx_type],
+                preprocessor=MODEL_DEFAULTS[idx_type]['preprocessor_']
+            )
+        except FileNotFoundError:
+            raise FileNotFoundError(f'Модель для этого способа индексации еще не скачена. Запустите команду '
+                                    f'"python -m thesis_search download {idx_type}", а потом попробуйте еще раз')
+        results = search_engine.search(query, n, filters, timings)
 
     if style == 'table':
         for result in results:
@@ -56,21 +83,160 @@ def search(query: str,
     elif style == 'text':
         pprint_result(results)
 
+    if profile:
+        if timings:
+            console.print(timings_table(timings))
+        else:
+            print('Результат взят из кэша, время этапов не измерялось')
+
+
+@app.command(help='Keep search engines in memory and serve queries of the search command on localhost')
+def serve(host: str = typer.Option(
+              default=DAEMON_SETTINGS['host'],
+              help='Address to listen on'
+          ),
+          port: int = typer.Option(
+              default=DAEMON_SETTINGS['port'],
+              help='Port to listen on'
+          ),
+          warm_up: bool = typer.Option(
+              default=True,
+              help='Load all engines right after the start (otherwise engines are loaded on the first query)'
+          )):
+    from ..search_models.engine_pool import EnginePool
+
+    search_engines = EnginePool(INDEX_TYPES, INDEX_FOLDER, db, MODEL_DEFAULTS, download=False)
+    if warm_up:
+        search_engines.warm_up()
+    print(f'Демон поиска запущен на {host}:{port} (Ctrl+C для остановки)')
+    serve_daemon(search_engines, host, port)
+
+
+@app.command(help='Download theses from HSE program pages into the database')
+def crawl(vkr_pages: List[str] = typer.Argument(..., help='Pages with theses of educational programs '
+                                                          '(for ex. https://www.hse.ru/ba/ling/students/diplomas/)'),
+          pagelimit: int = typer.Option(
+              default=30,
+              help='Maximum number of pages for every program'
+          ),
+          workers: int = typer.Option(
+              default=8,
+              help='Number of threads'
+          ),
+          rps: float = typer.Option(
+              default=5,
+              help='Maximum number of requests per second (0 - no limit)'
+          ),
+          checkpoint: Path = typer.Option(
+              default=Path(DATA_FOLDER, 'crawl_checkpoint.json'),
+              help='File with crawling progress, interrupted crawl continues from it'
+          ),
+          api_url: str = typer.Option(
+              default=None,
+              help='Theses API address (by default https://www.hse.ru/n/vkr/api/)'
+          )):
+    from ..utils.crawler import HSEVKRScrapper
+
+    scrapper = HSEVKRScrapper(request_url=api_url, requests_per_second=rps or None)
+    total = crawl_corpus(db, scrapper, vkr_pages, pagelimit, workers, checkpoint)
+    print(f'Добавлено вкр: {total}')
+
+
+@app.command(help='Lemmatize all texts in the database (needed after spacy model upgrade or adding new texts)')
+def lemmatize(batch_size: int = typer.Option(
+                  default=64,
+                  help='Number of texts in one spacy batch'
+              ),
+              n_process: int = typer.Option(
+                  default=-1,
+                  help='Number of processes (-1 to use all cores)'
+              ),
+              chunk_size: int = typer.Option(
+                  default=1000,
+                  help='Number of texts saved to the database in one transaction'
+              )):
+    total = lemmatize_corpus(db, load_nlp(), batch_size, n_process, chunk_size)
+    print(f'Лемматизировано текстов: {total}')
+
+
+@app.command(help='Add new theses from the database to all configured indices')
+def sync_indices():
+    from ..search_models.search_engine import SearchEngine
+
+    for idx_type in INDEX_TYPES:
+        try:
+            search_engine = SearchEngine(
+                index_type=idx_type,
+                implementation=MODEL_DEFAULTS[idx_type]['implementation'],
+                index_folder=INDEX_FOLDER,
+                data_retriever=db,
+                defaults=MODEL_DEFAULTS[idx_type],
+                preprocessor=MODEL_DEFAULTS[idx_type]['preprocessor_'],
+                sync_on_load=False  # новые документы добавляет sync, чтобы посчитать их
+            )
+        except FileNotFoundError:
+            print(f'Модель для {idx_type} еще не скачана, пропускаю')
+            continue
+        n_new = search_engine.sync()
+        print(f'{idx_type}: в индексе {len(search_engine.model.doc_idx)} документов (новых и измененных: {n_new})')
+
 
 @app.command(help='Show statistics of corpus search methods: time and memory')
 def stats():
+    import pandas as pd
+
     time_stats = pd.read_csv(Path(DATA_FOLDER, 'time_statistics.csv'), header=0, index_col=0)
     memory_stats = pd.read_csv(Path(DATA_FOLDER, 'memory_statistics.csv'), header=0, index_col=0)
 
     time_table = pandas_to_rich_table(time_stats)
-    time_table.title = 'Время (в секундах), затрачиваемое на поиск (full - вместе с инициализацией, search_only - только поиск):'
+    time_table.title = 'Время поиска (cold_start - загрузка и первый запрос в секундах, p50/p95/p99 - задержка ' \
+                       'в миллисекундах, qps - запросов в секунду):'
     console.print(time_table)
 
     memory_table = pandas_to_rich_table(memory_stats)
-    memory_table.title = 'Память (в байтах), затрачиваемая на поиск (full - вместе с инициализацией, search_only - только поиск):'
+    memory_table.title = 'Память процесса в байтах (rss - после загрузки индекса, peak_rss - максимальная):'
     console.print(memory_table)
 
 
+@app.command(help='Measure cold start, latency, throughput and memory of indices and save statistics for stats command')
+def bench(idx_types: List[str] = typer.Option(
+              default=None,
+              help=f'Index types to measure (can be repeated), by default all of: {list(INDEX_TYPES.keys())}'
+          ),
+          queries: Path = typer.Option(
+              default=None,
+              help='Text file with one query per line (by default a small built-in query set is used)'
+          ),
+          n: int = typer.Option(default=10, help='Number of documents in the result'),
+          repeat: int = typer.Option(default=5, help='Number of passes over the query set'),
+          output_dir: Path = typer.Option(default=DATA_FOLDER, help='Folder to save statistics to'),
+          baseline: Path = typer.Option(
+              default=None,
+              help='Folder with statistics of a previous run, exit code is 1 if some metric got worse'
+          ),
+          tolerance: float = typer.Option(default=0.2, help='Allowed relative regression compared to baseline')):
+    from .benchmark import DEFAULT_QUERIES, run_benchmark, save_statistics, load_statistics, compare_with_baseline
+
+    idx_types = idx_types or list(INDEX_TYPES)
+    unknown = set(idx_types) - set(INDEX_TYPES)
+    if unknown:
+        raise ValueError(f'Index type can be only one of those {list(INDEX_TYPES.keys())}')
+    query_set = [q.strip() for q in queries.read_text().splitlines() if q.strip()] if queries else DEFAULT_QUERIES
+
+    stats = run_benchmark(idx_types, query_set, n, repeat)
+    baseline_stats = load_statistics(baseline) if baseline else None  # до записи: baseline может быть output_dir
+    save_statistics(stats, output_dir)
+    console.print(pandas_to_rich_table(stats.round(4)))
+
+    if baseline_stats is not None:
+        regressions = compare_with_baseline(stats, baseline_stats, tolerance)
+        for regression in regressions:
+            print(f'Регрессия: {regression}')
+        if regressions:
+            raise typer.Exit(code=1)
+        print('Регрессий нет')
+
+
 @app.command(help="Show models' configurations")
 def show_config():
     tables = table_config(MODEL_DEFAULTS, INDEX_TYPES)
@@ -120,6 +286,7 @@ def download(idx_type: str = typer.Argument(..., help=f'One of the following mod
         filename = MODEL_DEFAULTS[idx_type]['model_path']
     else:
         filename = Path(source_link).with_suffix('.bin')
+    from ..search_models.search_engine import SearchEngine
     SearchEngine.download_model(idx_type, filename, source_link)
 
 
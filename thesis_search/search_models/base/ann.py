@@ -0,0 +1,166 @@
+import os
+import tempfile
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbour search: documents are split into clusters
+    by k-means (coarse quantizer), and the query is compared only with documents from nprobe clusters
+    whose centroids are the closest to the query
+    Attributes:
+        centroids: cluster centers, shape = (n_lists, emb_size)
+        list_offsets: offsets of the clusters in list_rows, shape = (n_lists + 1, )
+        list_rows: rows of the document matrix grouped by cluster, shape = (n_docs, )
+        nprobe: number of clusters that are searched (more clusters - better recall, but slower search)
+        fingerprint: hash of the documents the index was built for (saved index is rebuilt when it doesn't match)
+    """
+    def __init__(self,
+                 centroids: np.ndarray,
+                 list_offsets: np.ndarray,
+                 list_rows: np.ndarray,
+                 nprobe: int = 8,
+                 fingerprint: str = ''):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.nprobe = nprobe
+        self.fingerprint = fingerprint
+        self.centroid_norms = (centroids ** 2).sum(axis=1)
+
+    @property
+    def n_lists(self) -> int:
+        return self.centroids.shape[0]
+
+    @property
+    def n_docs(self) -> int:
+        return self.list_rows.shape[0]
+
+    @staticmethod
+    def assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 4096) -> np.ndarray:
+        """
+        Finds the nearest (in euclidean distance) centroid for every vector
+        Args:
+            vectors: matrix with shape = (n_vectors, emb_size)
+            centroids: matrix with shape = (n_lists, emb_size)
+            block_size: number of vectors processed at once
+
+        Returns: cluster number of every vector, shape = (n_vectors, )
+        """
+        centroid_norms = (centroids ** 2).sum(axis=1)
+        labels = np.empty(vectors.shape[0], dtype=np.int64)
+        for start in range(0, vectors.shape[0], block_size):
+            block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+            # ||x - c||^2 = ||x||^2 - 2 x·c + ||c||^2, ||x||^2 не влияет на argmin
+            labels[start:start + block_size] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+        return labels
+
+    @classmethod
+    def kmeans(cls,
+               vectors: np.ndarray,
+               n_lists: int,
+               n_iter: int = 20,
+               seed: int = 0) -> np.ndarray:
+        """
+        Lloyd's k-means, empty clusters are reinitialized with random vectors
+        Args:
+            vectors: training vectors, shape = (n_vectors, emb_size)
+            n_lists: number of clusters
+            n_iter: number of iterations
+            seed: random seed
+
+        Returns: centroids, shape = (n_lists, emb_size)
+        """
+        rng = np.random.default_rng(seed)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        centroids = vectors[rng.choice(vectors.shape[0], n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            labels = cls.assign(vectors, centroids)
+            counts = np.bincount(labels, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, vectors)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty].reshape(-1, 1)
+            n_empty = int((~non_empty).sum())
+            if n_empty:
+                centroids[~non_empty] = vectors[rng.choice(vectors.shape[0], n_empty, replace=False)]
+        return centroids
+
+    @classmethod
+    def build(cls,
+              matrix: np.ndarray,
+              n_lists: int = None,
+              nprobe: int = 8,
+              train_size: int = 256,
+              seed: int = 0) -> 'IVFIndex':
+        """
+        Trains coarse quantizer on a sample of documents and distributes all documents among clusters
+        Args:
+            matrix: document matrix, shape = (n_docs, emb_size)
+            n_lists: number of clusters (by default sqrt(n_docs))
+            nprobe: number of clusters that are searched
+            train_size: number of training vectors per cluster
+            seed: random seed
+
+        Returns: IVFIndex
+        """
+        n_docs = matrix.shape[0]
+        if not n_lists:
+            n_lists = int(np.sqrt(n_docs))
+        n_lists = max(1, min(n_lists, n_docs))
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n_docs, min(n_docs, n_lists * train_size), replace=False))
+        centroids = cls.kmeans(matrix[sample], n_lists, seed=seed)
+        return cls.from_labels(centroids, cls.assign(matrix, centroids), nprobe)
+
+    @classmethod
+    def from_labels(cls, centroids: np.ndarray, labels: np.ndarray, nprobe: int = 8) -> 'IVFIndex':
+        list_rows = np.argsort(labels, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=centroids.shape[0]))])
+        return cls(centroids, list_offsets, list_rows, nprobe)
+
+    def add(self, vectors: np.ndarray):
+        """
+        Adds new documents (rows n_docs, n_docs + 1, ... of the document matrix) to the nearest clusters
+        Args:
+            vectors: new rows of the document matrix, shape = (n_new, emb_size)
+        """
+        labels = np.empty(self.n_docs, dtype=np.int64)
+        labels[self.list_rows] = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        labels = np.concatenate([labels, self.assign(vectors, self.centroids)])
+        updated = self.from_labels(self.centroids, labels, self.nprobe)
+        self.list_offsets, self.list_rows = updated.list_offsets, updated.list_rows
+
+    def candidates(self, query_vector: np.ndarray) -> np.ndarray:
+        """
+        Selects documents from nprobe clusters whose centroids are the closest to the query in euclidean distance
+        (the same distance that is used to assign documents to clusters)
+        Args:
+            query_vector: vector with shape = (emb_size, 1), for cosine similarity it should be normalized
+                as the rows of the document matrix
+
+        Returns: sorted rows of the document matrix
+        """
+        # ||q - c||^2 = ||q||^2 - 2 q·c + ||c||^2, ||q||^2 не влияет на порядок
+        distances = self.centroid_norms - 2 * (self.centroids @ query_vector).reshape(-1)
+        nprobe = min(self.nprobe, self.n_lists)
+        lists = np.argpartition(distances, nprobe - 1)[:nprobe]
+        rows = [self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists]
+        return np.sort(np.concatenate(rows))
+
+    def save(self, path: Union[str, os.PathLike]):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows,
+                     fingerprint=np.array(self.fingerprint))
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike], nprobe: int = 8) -> 'IVFIndex':
+        with np.load(path) as data:
+            fingerprint = str(data['fingerprint']) if 'fingerprint' in data else ''
+            return cls(data['centroids'], data['list_offsets'], data['list_rows'], nprobe, fingerprint)
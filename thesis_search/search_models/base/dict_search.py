@@ -1,9 +1,10 @@
 from collections import defaultdict
-from typing import Iterable, Dict
+from typing import Iterable, Dict, Tuple, List, Any
 
 import pandas as pd
 
 from .search_engine import BaseSearch
+from ...utils.metrics import stage
 
 
 class DictSearch(BaseSearch):
@@ -26,11 +27,29 @@ class DictSearch(BaseSearch):
     def index(self, index: Dict[str, Dict[int, int]]):
         self._index = index
 
-    def rank_documents(self, lemmatized_query: str, top_n: int) -> Iterable[int]:
+    def rank_documents(self, lemmatized_query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
+        return self.score_documents(lemmatized_query, top_n, filters)[0]
+
+    def score_documents(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        rows = self.candidate_rows(filters)
+        allowed = None if rows is None else {self.doc_idx[i] for i in rows}
         scores = defaultdict(int)
-        for word in lemmatized_query.split():
-            if self.index.get(word):
-                for doc in self.index[word]:
-                    scores[doc] += self.index[word][doc]
-        sorted_metric = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        return [doc[0] for doc in sorted_metric[:top_n]]
\ No newline at end of file
+        with stage('score'):
+            for word in lemmatized_query.split():
+                postings = self.index.get(word)
+                if not postings:
+                    continue
+                if allowed is None:
+                    docs = postings
+                elif len(allowed) < len(postings):  # проходим по более короткому списку
+                    docs = [doc for doc in allowed if doc in postings]
+                else:
+                    docs = [doc for doc in postings if doc in allowed]
+                for doc in docs:
+                    scores[doc] += postings[doc]
+        with stage('top_k'):
+            rank = self.top_k_dict(scores, top_n)
+        return rank, [scores[doc] for doc in rank]
\ No newline at end of file
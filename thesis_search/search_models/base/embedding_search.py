@@ -1,6 +1,10 @@
+import hashlib
+import io
 import os
+import tempfile
 from abc import abstractmethod
-from typing import Iterable, Union
+from pathlib import Path
+from typing import Iterable, Union, List, Tuple, Dict, Any
 from collections import defaultdict
 
 import numpy as np
@@ -8,7 +12,9 @@ import pandas as pd
 from numpy.linalg import norm
 from scipy.sparse import csr_array
 
+from .ann import IVFIndex
 from .search_engine import BaseSearch
+from ...utils.metrics import stage
 
 
 class EmbeddingSearch(BaseSearch):
@@ -18,9 +24,11 @@ class EmbeddingSearch(BaseSearch):
         loaded: dictionary of loaded vector_models attributes {model_name: {attr: val}}
         model_name: name of pre-trained vector-model
         similarity: metric that is used to compute relevance od the document to the query
+        ann: approximate nearest neighbour index (None - exact search)
 
     """
     loaded = defaultdict(dict)  # информация о загруженных моделях
+    supports_incremental = True
 
     def __init__(self,
                  corpus: pd.DataFrame,
@@ -36,6 +44,7 @@ class EmbeddingSearch(BaseSearch):
         super().__init__(corpus)
         self.model_name = model_name
         self.similarity = similarity_metric
+        self.ann = None
 
     @abstractmethod
     def register_model(self):
@@ -45,26 +54,312 @@ class EmbeddingSearch(BaseSearch):
         """
         ...
 
+    def index_file(self, name: str) -> Path:
+        """
+        Path to the file of the precomputed index: <index_folder>/<model_name>_<name>
+        """
+        return Path(self.index_folder, f'{self.model_name}_{name}').resolve()
+
+    def init_index(self, index_folder: Union[str, os.PathLike]):
+        """
+        Loads precomputed index from index_folder or computes and saves it if there is no index yet.
+        Index in the old text format (<model_name>_index.txt) is converted to the binary one.
+        Ids of indexed documents are stored in <model_name>_ids.npy: documents of the corpus that are not
+        in the index yet should be added with add_documents. If some indexed documents were removed from
+        the corpus, the index is recomputed. Hashes of embedded texts are stored in <model_name>_hashes.npy:
+        documents whose texts changed (for ex. after lemmatize) are embedded again.
+        For cosine similarity the index with normalized rows (<model_name>_index_normed.npy) is also loaded
+        Args:
+            index_folder: folder where precomputed index should be stored
+        """
+        self.index_folder = index_folder
+        index_path = self.index_file('index.npy')
+        legacy_path = self.index_file('index.txt')
+        if not index_path.exists() and legacy_path.exists():
+            self.remove_derived_files()
+            self.convert_text_index(legacy_path, index_path)
+        if index_path.exists():
+            self.index = self.load_index(index_path)
+            ids = self.load_indexed_ids()
+            if len(ids) != self.index.shape[0] or not np.isin(ids, self.doc_idx.to_numpy()).all():
+                print(f'Документы индекса {self.model_name} не совпадают с корпусом, индекс будет пересчитан')
+                index_path.unlink()
+        if not index_path.exists():
+            self.remove_derived_files()
+            self.index = self.compute_index()
+            self.save_index(index_path)
+            self.save_matrix(self.doc_idx.to_numpy(), self.index_file('ids.npy'), dtype=np.int64)
+            self.save_matrix(self.text_hashes(self.text), self.index_file('hashes.npy'), dtype=np.uint64)
+        self.index = self.load_index(index_path)
+
+        corpus = pd.DataFrame({'id': self.doc_idx, 'text': self.text})
+        self.doc_idx = pd.Series(self.load_indexed_ids(), name=self.doc_idx.name)
+        self.text = corpus.set_index('id')['text'].reindex(self.doc_idx).reset_index(drop=True)
+        self.update_normed_index()
+        self.update_changed_documents()
+
+    def remove_derived_files(self):
+        """
+        Removes files that are computed from the index (ids, normalized index, ann index)
+        """
+        for name in ['ids.npy', 'hashes.npy', 'index_normed.npy', 'ivf.npz']:
+            self.index_file(name).unlink(missing_ok=True)
+
+    def load_indexed_ids(self) -> np.ndarray:
+        """
+        Loads ids of indexed documents (row i of the index is the document ids[i]). Indices that were built before
+        ids were saved are considered to contain the first n_rows documents of the corpus
+        Returns: array of document ids, shape = (n_docs, )
+        """
+        ids_path = self.index_file('ids.npy')
+        if not ids_path.exists():
+            if self.index.shape[0] > len(self.doc_idx):
+                raise ValueError(f'Index {self.model_name} has more documents than the corpus, delete it to rebuild')
+            self.save_matrix(self.doc_idx.to_numpy()[:self.index.shape[0]], ids_path, dtype=np.int64)
+        return np.load(ids_path)
+
+    def load_indexed_hashes(self) -> np.ndarray:
+        """
+        Loads hashes of embedded texts (see BaseSearch.text_hashes). Indices that were saved without hashes
+        are considered to be computed from the current texts
+        Returns: array of hashes, shape = (n_docs, )
+        """
+        hashes_path = self.index_file('hashes.npy')
+        if hashes_path.exists():
+            hashes = np.load(hashes_path)
+            if len(hashes) == len(self.doc_idx):
+                return hashes
+        hashes = self.text_hashes(self.text)
+        self.save_matrix(hashes, hashes_path, dtype=np.uint64)
+        return hashes
+
+    def update_changed_documents(self) -> int:
+        """
+        Embeds again documents whose texts differ from the embedded ones and overwrites their rows in the saved
+        index files (ann index is rebuilt, because its clusters were computed for the old vectors)
+        Returns: number of updated documents
+        """
+        rows = np.flatnonzero(self.load_indexed_hashes() != self.text_hashes(self.text))
+        if not len(rows):
+            return 0
+        print(f'Обновляю в индексе {self.model_name} измененных документов: {len(rows)}')
+        texts = self.text.iloc[rows].tolist()
+        vectors = np.asarray(self.compute_index(texts), dtype=np.float32).reshape(len(rows), -1)
+        self.write_rows(vectors, rows, self.index_file('index.npy'))
+        self.index = self.load_index(self.index_file('index.npy'))
+        if self.similarity_metric == 'cosine':
+            self.write_rows(self.normalize(vectors, axis=1), rows, self.index_file('index_normed.npy'))
+            self.normed_index = self.load_index(self.index_file('index_normed.npy'))
+        self.write_rows(self.text_hashes(texts), rows, self.index_file('hashes.npy'), dtype=np.uint64)
+
+        self.index_file('ivf.npz').unlink(missing_ok=True)
+        if self.ann is not None:
+            self.ann = IVFIndex.build(self.search_matrix, self.ann.n_lists, self.ann.nprobe)
+            self.save_ann()
+        return len(rows)
+
+    def update_normed_index(self):
+        """
+        Loads normalized index for cosine similarity, normalizing rows that are missing in it
+        """
+        if self.similarity_metric != 'cosine':
+            return
+        normed_path = self.index_file('index_normed.npy')
+        if normed_path.exists():
+            normed = self.load_index(normed_path)
+            if normed.shape[0] < self.index.shape[0]:
+                self.append_rows(self.normalize(self.index[normed.shape[0]:], axis=1), normed_path)
+            elif normed.shape[0] > self.index.shape[0]:
+                self.save_matrix(self.normalize(self.index, axis=1), normed_path)
+        else:
+            self.save_matrix(self.normalize(self.index, axis=1), normed_path)
+        self.normed_index = self.load_index(normed_path)
+
+    def add_documents(self, corpus: pd.DataFrame):
+        """
+        Embeds documents that are not in the index yet and appends them to the saved index files in place
+        (as well as to normalized and ann indices). Documents whose texts changed are embedded again
+        Args:
+            corpus: pandas dataframe with two columns: text ids and texts themselves
+        """
+        ids, texts = [corpus[col] for col in corpus.columns]
+        changed = self.changed_rows(corpus)
+        if len(changed):
+            current = pd.Series(texts.to_numpy(), index=ids.to_numpy())
+            text = self.text.to_numpy(dtype=object)
+            text[changed] = current.loc[self.doc_idx.to_numpy()[changed]].to_numpy()
+            self.text = pd.Series(text)
+            self.update_changed_documents()
+
+        new = ~ids.isin(self.doc_idx)
+        if not new.any():
+            return
+        ids, texts = ids[new].reset_index(drop=True), texts[new].reset_index(drop=True)
+        print(f'Добавляю в индекс {self.model_name} новых документов: {len(ids)}')
+
+        vectors = np.asarray(self.compute_index(texts.tolist()), dtype=np.float32).reshape(len(ids), -1)
+        self.doc_idx = pd.concat([self.doc_idx, ids], ignore_index=True)
+        self.text = pd.concat([self.text, texts], ignore_index=True)
+        index_path = self.index_file('index.npy')
+        self.append_rows(vectors, index_path)
+        self.append_rows(ids.to_numpy(), self.index_file('ids.npy'), dtype=np.int64)
+        self.append_rows(self.text_hashes(texts), self.index_file('hashes.npy'), dtype=np.uint64)
+        self.index = self.load_index(index_path)
+        self.update_normed_index()
+
+        if self.ann is not None:
+            self.ann.add(self.search_matrix[self.ann.n_docs:])
+            self.save_ann()
+
+    def init_ann(self,
+                 index_folder: Union[str, os.PathLike],
+                 method: str = 'ivf',
+                 n_lists: int = None,
+                 nprobe: int = 8,
+                 min_docs: int = 10000):
+        """
+        Loads approximate nearest neighbour index from index_folder (<model_name>_ivf.npz) or builds it.
+        Saved index is used only if it was built for the same first rows of the current matrix (see ann_fingerprint),
+        rows appended after that are added to it. Small corpora are searched exactly
+        Args:
+            index_folder: folder where precomputed index should be stored
+            method: ann method ('ivf' or 'exact')
+            n_lists: number of clusters (if None - sqrt(n_docs))
+            nprobe: number of clusters that are searched for each query
+            min_docs: if there are fewer documents the search is exact
+        """
+        if method == 'exact' or self.index.shape[0] < min_docs:
+            self.ann = None
+            return
+        if method != 'ivf':
+            raise ValueError('Unknown ann method')
+
+        ann_path = Path(index_folder, f'{self.model_name}_ivf.npz').resolve()
+        if ann_path.exists():
+            self.ann = IVFIndex.load(ann_path, nprobe)
+            if (self.ann.n_docs <= self.index.shape[0] and (not n_lists or self.ann.n_lists == n_lists)
+                    and self.ann.fingerprint == self.ann_fingerprint(self.ann.n_docs)):
+                if self.ann.n_docs < self.index.shape[0]:
+                    self.ann.add(self.search_matrix[self.ann.n_docs:])
+                    self.save_ann()
+                return
+        print(f'Строю ivf индекс для {self.model_name}...')
+        self.ann = IVFIndex.build(self.search_matrix, n_lists, nprobe)
+        self.save_ann()
+
+    def ann_fingerprint(self, n_docs: int) -> str:
+        """
+        Hash of ids and texts of the first n_docs documents of the index and the similarity metric
+        (ann index is built for the normalized matrix with cosine similarity)
+        """
+        data = [self.similarity_metric.encode(), self.doc_idx.to_numpy()[:n_docs].astype(np.int64).tobytes(),
+                self.text_hashes(self.text[:n_docs]).tobytes()]
+        return hashlib.sha1(b''.join(data)).hexdigest()
+
+    def save_ann(self):
+        self.ann.fingerprint = self.ann_fingerprint(self.ann.n_docs)
+        self.ann.save(self.index_file('ivf.npz'))
+
     def save_index(self, index_path: Union[str, os.PathLike]):
         """
-        Saves precomputed index to index_path
+        Saves precomputed index to index_path in .npy format (float32)
         Args:
             index_path: path to index file
         """
+        self.save_matrix(self.index, index_path)
 
-        np.savetxt(index_path, self.index)
+    @staticmethod
+    def save_matrix(matrix: np.ndarray, path: Union[str, os.PathLike], dtype=np.float32):
+        """
+        Atomically writes matrix to the .npy file, so that other processes never see partially written file
+        Args:
+            matrix: matrix to save
+            path: path to .npy file
+            dtype: type of saved values
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+            np.save(f, np.ascontiguousarray(matrix, dtype=dtype))
+        os.replace(f.name, path)
+
+    @classmethod
+    def append_rows(cls, rows: np.ndarray, path: Union[str, os.PathLike], dtype=np.float32):
+        """
+        Appends rows to the .npy file without rewriting it: rows are written after the existing data and then
+        the header is overwritten with the new shape (np.save pads the header, so it usually keeps its length).
+        Readers that opened the file earlier keep seeing the old rows. If the file can't be extended in place,
+        it is rewritten with save_matrix
+        Args:
+            rows: rows to append, shape = (n_rows, ...) with the same trailing dimensions as the saved matrix
+            path: path to .npy file
+            dtype: type of saved values
+        """
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        with open(path, 'r+b') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, saved_dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, saved_dtype = np.lib.format.read_array_header_2_0(f)
+            header_len = f.tell()
+            header = io.BytesIO()
+            if not fortran_order and saved_dtype == rows.dtype and shape[1:] == rows.shape[1:]:
+                write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) \
+                    else np.lib.format.write_array_header_2_0
+                write_header(header, {'descr': np.lib.format.dtype_to_descr(saved_dtype), 'fortran_order': False,
+                                      'shape': (shape[0] + rows.shape[0], ) + shape[1:]})
+            if header.tell() == header_len:
+                f.seek(header_len + int(np.prod(shape)) * saved_dtype.itemsize)
+                f.write(rows.tobytes())
+                f.truncate()
+                f.flush()
+                f.seek(0)
+                f.write(header.getvalue())  # заголовок пишется последним, до этого видны только старые строки
+                return
+        cls.save_matrix(np.concatenate([np.load(path), rows]), path, dtype=dtype)
+
+    @staticmethod
+    def write_rows(values: np.ndarray, rows: np.ndarray, path: Union[str, os.PathLike], dtype=np.float32):
+        """
+        Overwrites rows of the .npy file in place
+        Args:
+            values: new values of the rows, shape = (n_rows, ...)
+            rows: positions of the rows
+            path: path to .npy file
+            dtype: type of saved values
+        """
+        matrix = np.load(path, mmap_mode='r+')
+        matrix[rows] = np.asarray(values, dtype=dtype)
+        matrix.flush()
+        del matrix
 
     @staticmethod
     def load_index(index_path: Union[str, os.PathLike]) -> np.ndarray:
         """
-        Loads precomputed index from the file
+        Opens precomputed index as read-only memory map, so the loading is instant and
+        different processes share the same page cache
         Args:
             index_path: path to index file
 
         Returns: numpy ndarray with shape (n_docs, emb_size)
 
         """
-        return np.loadtxt(index_path)
+        return np.load(index_path, mmap_mode='r')
+
+    @classmethod
+    def convert_text_index(cls,
+                           text_path: Union[str, os.PathLike],
+                           index_path: Union[str, os.PathLike]):
+        """
+        Converts index saved with np.savetxt to the binary format and removes the text file
+        Args:
+            text_path: path to the old text index
+            index_path: path to the new .npy index
+        """
+        print(f'Конвертирую индекс {text_path} в бинарный формат...')
+        cls.save_matrix(np.loadtxt(text_path, ndmin=2), index_path)
+        Path(text_path).unlink()
 
     @property
     def index(self):
@@ -78,6 +373,25 @@ class EmbeddingSearch(BaseSearch):
     def index(self, index_matrix: csr_array):
         self.loaded[self.model_name]['index'] = index_matrix
 
+    @property
+    def normed_index(self):
+        """
+        Matrix of vectorized documents with rows normalized to unit length (zero rows stay zero)
+        # shape = (n_docs, emb_size)
+        """
+        return self.loaded[self.model_name]['normed_index']
+
+    @normed_index.setter
+    def normed_index(self, index_matrix: np.ndarray):
+        self.loaded[self.model_name]['normed_index'] = index_matrix
+
+    @property
+    def search_matrix(self) -> np.ndarray:
+        """
+        Matrix that is multiplied by the query vector: normalized index for cosine similarity and raw index otherwise
+        """
+        return self.normed_index if self.similarity_metric == 'cosine' else self.index
+
     @property
     def model(self):
         return self.loaded[self.model_name]['model']
@@ -94,21 +408,35 @@ class EmbeddingSearch(BaseSearch):
             self._similarity = self.cosine_similarity
         else:
             raise ValueError('Wrong similarity metric')
+        self.similarity_metric = value
 
     @staticmethod
-    def cosine_similarity(documents: np.ndarray, query_vector: np.ndarray) -> np.ndarray:
+    def normalize(vectors: np.ndarray, axis: int) -> np.ndarray:
         """
-        Computed cosine similarity of documents and the query
+        Divides vectors by their norm, zero vectors are left as they are
         Args:
-            documents: document embeddings shape=(n_docs, emb_size)
-            query_vector: query vector shape=(emb_size, 1)
+            vectors: matrix of vectors
+            axis: axis along which vectors are stored (1 - rows, 0 - columns)
+
+        Returns: matrix of normalized vectors
+        """
+        norms = norm(vectors, axis=axis, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    @classmethod
+    def cosine_similarity(cls, documents: np.ndarray, query_vector: np.ndarray) -> np.ndarray:
+        """
+        Computed cosine similarity of documents and the query as dot product with normalized query
+        Args:
+            documents: document embeddings normalized to unit length shape=(n_docs, emb_size)
+            query_vector: query vector shape=(emb_size, 1) or matrix of query vectors shape=(emb_size, n_queries)
 
         Returns: vector filled with values of documents' cosine similarities shape=(n_docs, 1)
+            (or (n_docs, n_queries) for many queries)
 
         """
-        return (documents @ query_vector) / (
-                norm(documents, axis=1, keepdims=True) * norm(query_vector, keepdims=True)
-        )
+        return documents @ cls.normalize(query_vector, axis=0)
 
     @staticmethod
     def dot_prod_similarity(documents: np.ndarray, query_vector: np.ndarray) -> np.ndarray:
@@ -124,9 +452,12 @@ class EmbeddingSearch(BaseSearch):
         return documents @ query_vector
 
     @abstractmethod
-    def compute_index(self) -> np.ndarray:
+    def compute_index(self, texts: List[str] = None) -> np.ndarray:
         """
         Computes index for corpus documents
+        Args:
+            texts: texts to embed (if None - all texts of the corpus)
+
         Returns: numpy ndarray with the shape = (n_docs, emb_size)
 
         """
@@ -144,8 +475,56 @@ class EmbeddingSearch(BaseSearch):
         """
         ...
 
-    def rank_documents(self, lemmatized_query: str, top_n: int) -> Iterable[int]:
-        query_vector = self.vectorize(lemmatized_query)
-        scores = self.similarity(self.index, query_vector)
-        rank = (-scores).argsort(axis=0)[:, 0]
-        return self.doc_idx[rank][:top_n].tolist()
+    def vectorize_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Computes embeddings of many texts
+        Args:
+            texts: list of texts
+
+        Returns: matrix with shape = (emb_size, n_texts)
+
+        """
+        return np.hstack([self.vectorize(text) for text in texts])
+
+    def rank_documents(self, lemmatized_query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
+        return self.score_documents(lemmatized_query, top_n, filters)[0]
+
+    def score_documents(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        with stage('vectorize'):
+            query_vector = self.vectorize(lemmatized_query)
+        rows = self.candidate_rows(filters)  # с фильтрами поиск точный, но только по подходящим документам
+        if rows is not None or self.ann is not None:
+            with stage('score'):
+                if rows is None:
+                    probe_vector = self.normalize(query_vector, axis=0) if self.similarity_metric == 'cosine' \
+                        else query_vector
+                    rows = self.ann.candidates(probe_vector)
+                scores = np.asarray(self.similarity(self.search_matrix[rows], query_vector)).reshape(-1)
+            with stage('top_k'):
+                top = self.top_k(scores, top_n)
+            rank, top_scores = rows[top], scores[top]
+        else:
+            with stage('score'):
+                scores = np.asarray(self.similarity(self.search_matrix, query_vector)).reshape(-1)
+            with stage('top_k'):
+                rank = self.top_k(scores, top_n)
+            top_scores = scores[rank]
+        return self.doc_idx[rank].tolist(), top_scores.tolist()
+
+    def rank_documents_batch(self,
+                             lemmatized_queries: List[str],
+                             top_n: int,
+                             block_size: int = 256) -> List[List[int]]:
+        """
+        Scores queries with one matrix product per block of block_size queries
+        (blocks limit the size of (n_docs, block_size) score matrix). Batch search is always exact
+        """
+        result = []
+        for start in range(0, len(lemmatized_queries), block_size):
+            query_vectors = self.vectorize_batch(lemmatized_queries[start:start + block_size])
+            scores = self.similarity(self.search_matrix, query_vectors)  # (n_docs, block_size)
+            result.extend(self.doc_idx[self.top_k(scores[:, j], top_n)].tolist() for j in range(scores.shape[1]))
+        return result
@@ -0,0 +1,183 @@
+import json
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+
+from .embedding_search import EmbeddingSearch
+
+WHITESPACE = re.compile(r'[ \t\n\v\f\r]+')  # fasttext делит строку только по ascii-пробелам (std::istream >>)
+
+
+class FastTextVectors:
+    """
+    Part of fasttext model that is needed to compute sentence vectors: normalized vectors of a bounded vocabulary
+    and the matrix of subword n-gram buckets, both opened as read-only memory maps.
+    Words that are not in the exported vocabulary get vectors from their n-grams (as out-of-vocabulary words
+    in fasttext), so only for words of the full model vocabulary that were not exported vectors differ from fasttext
+    Files (for model <folder>/<name>.bin):
+        <name>.lite.json - model parameters (dim, minn, maxn, bucket) and size and mtime of the model file
+        <name>.ngrams_<dtype>.npy - n-gram buckets, shape = (bucket, dim)
+        <name>.words_<top_n>_<dtype>.txt, <name>.words_<top_n>_<dtype>.npy - exported words and their
+            normalized vectors
+    Attributes:
+        dim: vector size
+        minn, maxn: minimum and maximum length of n-grams in characters
+        bucket: number of n-gram buckets
+        words: {word: row of word_vectors}
+        word_vectors: normalized word vectors, shape = (n_words, dim)
+        ngrams: n-gram bucket vectors, shape = (bucket, dim)
+    """
+    BOW, EOW = '<', '>'
+
+    def __init__(self, words: List[str], word_vectors: np.ndarray, ngrams: np.ndarray, minn: int, maxn: int):
+        self.words = {word: i for i, word in enumerate(words)}
+        self.word_vectors = word_vectors
+        self.ngrams = ngrams
+        self.bucket, self.dim = ngrams.shape
+        self.minn = minn
+        self.maxn = maxn
+        self.subwords = lru_cache(maxsize=100000)(self._subwords)
+
+    @staticmethod
+    def hash(ngram: bytes) -> int:
+        """
+        32-bit FNV-1a as in fasttext: bytes are converted to int8 before xor,
+        so bytes >= 0x80 (all non-ascii utf-8 bytes) are sign-extended
+        """
+        h = 2166136261
+        for byte in ngram:
+            h ^= byte | 0xFFFFFF00 if byte & 0x80 else byte
+            h = (h * 16777619) & 0xFFFFFFFF
+        return h
+
+    def _subwords(self, word: str) -> np.ndarray:
+        """
+        Buckets of character n-grams of <word> (n-grams of one character that are BOW or EOW are skipped),
+        repeated buckets are kept as fasttext does
+        """
+        if self.maxn <= 0:
+            return np.empty(0, dtype=np.int64)
+        chars = self.BOW + word + self.EOW
+        buckets = []
+        for i in range(len(chars)):
+            for n in range(self.minn, min(self.maxn, len(chars) - i) + 1):
+                if n == 1 and (i == 0 or i + n == len(chars)):
+                    continue
+                buckets.append(self.hash(chars[i:i + n].encode('utf-8')) % self.bucket)
+        return np.array(buckets, dtype=np.int64)
+
+    def get_word_vector(self, word: str) -> np.ndarray:
+        """
+        Returns: vector of the word (normalized for the exported words), zeros if the word has no n-grams
+        """
+        row = self.words.get(word)
+        if row is not None:
+            return np.asarray(self.word_vectors[row], dtype=np.float32)
+        buckets = self.subwords(word)
+        if not len(buckets):
+            return np.zeros(self.dim, dtype=np.float32)
+        return np.asarray(self.ngrams[buckets], dtype=np.float32).mean(axis=0)
+
+    def get_sentence_vector(self, text: str) -> np.ndarray:
+        """
+        Mean of normalized word vectors (words with zero vectors are skipped), same as fasttext get_sentence_vector
+        for unsupervised models
+        """
+        sentence = np.zeros(self.dim, dtype=np.float32)
+        count = 0
+        for word in WHITESPACE.split(text):
+            if not word:
+                continue
+            vector = self.get_word_vector(word)
+            vector_norm = np.linalg.norm(vector)
+            if vector_norm > 0:
+                sentence += vector / vector_norm
+                count += 1
+        return sentence / count if count else sentence
+
+    def get_dimension(self) -> int:
+        return self.dim
+
+    @staticmethod
+    def paths(model_path: Union[str, os.PathLike], top_n: int, dtype: str) -> dict:
+        model_path = Path(model_path)
+        return {
+            'meta': model_path.with_suffix('.lite.json'),
+            'ngrams': model_path.with_suffix(f'.ngrams_{dtype}.npy'),
+            'words': model_path.with_suffix(f'.words_{top_n}_{dtype}.txt'),
+            'word_vectors': model_path.with_suffix(f'.words_{top_n}_{dtype}.npy'),
+        }
+
+    @staticmethod
+    def model_stamp(model_path: Union[str, os.PathLike]) -> dict:
+        """
+        Size and modification time of the model file (exported files are made again when the model is replaced)
+        """
+        stat = Path(model_path).stat()
+        return {'model_size': stat.st_size, 'model_mtime': stat.st_mtime_ns}
+
+    @classmethod
+    def exists(cls, model_path: Union[str, os.PathLike], top_n: int, dtype: str) -> bool:
+        paths = cls.paths(model_path, top_n, dtype)
+        if not all(path.exists() for path in paths.values()):
+            return False
+        if not Path(model_path).exists():  # модель можно удалить после экспорта
+            return True
+        meta = json.loads(paths['meta'].read_text())
+        return all(meta.get(key) == value for key, value in cls.model_stamp(model_path).items())
+
+    @classmethod
+    def export(cls,
+               model,
+               model_path: Union[str, os.PathLike],
+               top_n: int,
+               dtype: str = 'float16'):
+        """
+        Saves vectors of top_n most frequent words of the model (fasttext words are sorted by frequency)
+        and the n-gram buckets. Other words, including words of the corpus, get vectors from n-grams.
+        Files exported with other settings are removed
+        Args:
+            model: loaded fasttext model (unsupervised)
+            model_path: path to the .bin file of the model
+            top_n: number of the most frequent words to export
+            dtype: type of saved vectors ('float16' or 'float32')
+        """
+        model_path = Path(model_path)
+        paths = cls.paths(model_path, top_n, dtype)
+        for pattern in ['words_*', 'ngrams_*']:
+            for stale in model_path.parent.glob(f'{model_path.stem}.{pattern}'):
+                if stale not in paths.values():
+                    stale.unlink()
+
+        model_words = model.get_words(include_freq=False)
+        EmbeddingSearch.save_matrix(model.get_input_matrix()[len(model_words):], paths['ngrams'], dtype=dtype)
+        words = model_words[:top_n]
+        vectors = np.array([model.get_word_vector(w) for w in words], dtype=np.float32).reshape(len(words), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        tmp_path = paths['words'].with_suffix('.tmp')
+        tmp_path.write_text('\n'.join(words), encoding='utf-8')
+        os.replace(tmp_path, paths['words'])
+        EmbeddingSearch.save_matrix(vectors / norms, paths['word_vectors'], dtype=dtype)
+        # параметры пишутся последними: пока их нет, экспорт считается незавершенным
+        args = model.f.getArgs()  # у модели из load_model нет атрибутов minn, maxn, bucket
+        paths['meta'].write_text(json.dumps({'dim': model.get_dimension(), 'minn': args.minn, 'maxn': args.maxn,
+                                             'bucket': args.bucket, **cls.model_stamp(model_path)}))
+
+    @classmethod
+    def load(cls,
+             model_path: Union[str, os.PathLike],
+             top_n: int,
+             dtype: str = 'float16') -> 'FastTextVectors':
+        paths = cls.paths(model_path, top_n, dtype)
+        meta = json.loads(paths['meta'].read_text())
+        words = paths['words'].read_text(encoding='utf-8').split('\n')
+        return cls(words=words,
+                   word_vectors=np.load(paths['word_vectors'], mmap_mode='r'),
+                   ngrams=np.load(paths['ngrams'], mmap_mode='r'),
+                   minn=meta['minn'],
+                   maxn=meta['maxn'])
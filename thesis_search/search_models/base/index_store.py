@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Union, Dict, Any
+
+import numpy as np
+
+
+class IndexStore:
+    """
+    Folder with index arrays saved as .npy files. Name of the folder contains hash of the index parameters,
+    so an index built with other parameters is never loaded. The corpus is not a part of the key: ids of indexed
+    documents are saved with the index, so that new documents can be added to it instead of rebuilding
+    Attributes:
+        root: folder with all saved indices
+        name: name of the index (folders of the index with other keys are considered stale)
+        path: folder of the index with the given key
+    """
+    def __init__(self, index_folder: Union[str, os.PathLike], name: str, params: Dict[str, Any] = None):
+        self.root = Path(index_folder)
+        self.name = name
+        self.path = self.root / f'{name}_{self.make_key(params)}'
+
+    @staticmethod
+    def make_key(params: Dict[str, Any] = None) -> str:
+        params = json.dumps(params or {}, sort_keys=True)
+        return hashlib.sha1(params.encode()).hexdigest()[:16]
+
+    def exists(self) -> bool:
+        return self.path.is_dir()
+
+    def save(self, arrays: Dict[str, np.ndarray]):
+        """
+        Writes arrays into temporary folder and then renames it, so other processes never see
+        partially written index. Folders of the same index with other keys are removed
+        Args:
+            arrays: mapping of file names to arrays
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(tempfile.mkdtemp(dir=self.root, prefix=f'.{self.name}_'))
+        for name, array in arrays.items():
+            np.save(tmp_path / f'{name}.npy', np.ascontiguousarray(array))
+        if self.exists():
+            shutil.rmtree(self.path)
+        os.replace(tmp_path, self.path)
+        self.remove_stale()
+
+    def load(self, mmap_mode: str = 'r') -> Dict[str, np.ndarray]:
+        """
+        Opens saved arrays as read-only memory maps
+        Returns: mapping of file names to arrays
+        """
+        return {file.stem: np.load(file, mmap_mode=mmap_mode) for file in self.path.glob('*.npy')}
+
+    def remove_stale(self):
+        for folder in self.root.glob(f'{self.name}_*'):
+            if folder.is_dir() and folder != self.path:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    @staticmethod
+    def vocabulary_to_arrays(vocabulary: Dict[str, int]) -> Dict[str, np.ndarray]:
+        """
+        Converts mapping of terms to feature indices to terms ordered by feature index, stored as one utf-8 buffer
+        and offsets of terms in it (fixed-width string array would make every term as long as the longest one)
+        Returns: {'vocabulary_data': utf-8 bytes of all terms, 'vocabulary_offsets': shape = (vocab_size + 1, )}
+        """
+        terms = [b''] * len(vocabulary)
+        for term, i in vocabulary.items():
+            terms[i] = term.encode('utf-8')
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in terms], out=offsets[1:])
+        return {'vocabulary_data': np.frombuffer(b''.join(terms), dtype=np.uint8),
+                'vocabulary_offsets': offsets}
+
+    @staticmethod
+    def arrays_to_vocabulary(arrays: Dict[str, np.ndarray]) -> Dict[str, int]:
+        data = np.asarray(arrays['vocabulary_data']).tobytes()
+        offsets = arrays['vocabulary_offsets'].tolist()
+        return {data[start:end].decode('utf-8'): i for i, (start, end) in enumerate(zip(offsets, offsets[1:]))}
@@ -0,0 +1,210 @@
+from typing import Iterable, Tuple, Dict, List, Any
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_array, csr_array
+
+from .index_store import IndexStore
+from .matrix_search import MatrixSearch
+from .search_engine import BaseSearch
+from ...utils.metrics import stage
+
+
+class InvertedSearch(BaseSearch):
+    """
+    Search in the compact inverted index. Posting lists of all terms are stored one after another in
+    contiguous arrays (like columns of csc matrix), query is processed term-at-a-time with MaxScore pruning
+    Attributes:
+        _vocabulary: mapping of terms to term indices
+        _indptr: offsets of terms' posting lists, shape = (vocab_size + 1, )
+        _postings: positions of documents (int32), sorted inside each posting list, shape = (n_postings, )
+        _scores: score of the term in the document (float32), shape = (n_postings, )
+        _max_scores: maximum score of each term (float32), shape = (vocab_size, )
+        _doc_term_count: document-term matrix filled with term counts (needed to add new documents)
+    """
+    supports_incremental = True
+
+    def __init__(self, corpus: pd.DataFrame):
+        super().__init__(corpus)
+        self.doc_idx = self.doc_idx.to_numpy()
+        self._vocabulary = None
+        self._doc_term_count = None
+        self._indptr = None
+        self._postings = None
+        self._scores = None
+        self._max_scores = None
+
+    @property
+    def index(self) -> csc_array:
+        """
+        Index in the form of sparse document-term matrix (shape=(n_docs, vocab_size)) filled with scores
+        """
+        return csc_array((self._scores, self._postings, self._indptr), shape=(len(self.doc_idx), len(self._indptr) - 1))
+
+    @index.setter
+    def index(self, index_matrix: csr_array):
+        index_matrix = csc_array(index_matrix)
+        index_matrix.sum_duplicates()  # заодно сортирует документы внутри списков
+        self._indptr = index_matrix.indptr.astype(np.int64)
+        self._postings = index_matrix.indices.astype(np.int32)
+        self._scores = index_matrix.data.astype(np.float32)
+
+        terms = np.repeat(np.arange(index_matrix.shape[1]), np.diff(self._indptr))
+        self._max_scores = np.zeros(index_matrix.shape[1], dtype=np.float32)
+        np.maximum.at(self._max_scores, terms, self._scores)
+
+    def weigh(self, doc_term_count: csr_array) -> csr_array:
+        """
+        Transforms matrix of term counts into the matrix of scores (by default counts are used as they are)
+        """
+        return doc_term_count
+
+    def build_index(self):
+        self._doc_term_count, self._vocabulary = MatrixSearch.extract_features(self.text)
+        self.index = self.weigh(self._doc_term_count)
+
+    def index_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            **IndexStore.vocabulary_to_arrays(self._vocabulary),
+            'counts_data': self._doc_term_count.data,
+            'counts_indices': self._doc_term_count.indices,
+            'counts_indptr': self._doc_term_count.indptr,
+            'indptr': self._indptr,
+            'postings': self._postings,
+            'scores': self._scores,
+            'max_scores': self._max_scores,
+            'ids': self.doc_idx,
+            'hashes': self.text_hashes(self.text)
+        }
+
+    def restore_index(self, arrays: Dict[str, np.ndarray]):
+        self.doc_idx = np.asarray(arrays['ids'])
+        self._vocabulary = IndexStore.arrays_to_vocabulary(arrays)
+        self._doc_term_count = csr_array(
+            (arrays['counts_data'], arrays['counts_indices'], arrays['counts_indptr']),
+            shape=(len(self.doc_idx), len(self._vocabulary))
+        )
+        self._indptr = arrays['indptr']
+        self._postings = arrays['postings']
+        self._scores = arrays['scores']
+        self._max_scores = arrays['max_scores']
+
+    def add_documents(self, corpus: pd.DataFrame):
+        """
+        Adds term counts of new documents and rebuilds posting lists from the updated counts.
+        If texts of indexed documents changed, the index is rebuilt from the corpus
+        """
+        ids, texts = [corpus[col] for col in corpus.columns]
+        if len(self.changed_rows(corpus)):
+            self.doc_idx, self.text = ids.to_numpy(), texts.reset_index(drop=True)
+            self.build_index()
+            self.save_updated_index()
+            return
+        new = ~ids.isin(self.doc_idx)
+        if not new.any():
+            return
+        ids, texts = ids[new].reset_index(drop=True), texts[new].reset_index(drop=True)
+        doc_term_count, self._vocabulary = MatrixSearch.extract_features(texts, self._vocabulary)
+        self._doc_term_count = MatrixSearch.stack_rows(self._doc_term_count, doc_term_count)
+        self.doc_idx = np.concatenate([self.doc_idx, ids.to_numpy()])
+        self.text = pd.concat([self.text, texts], ignore_index=True)
+        self.index = self.weigh(self._doc_term_count)
+        self.save_updated_index()
+
+    def max_score_top_k(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds top_n documents using MaxScore: terms are processed in the order of decreasing maximum score.
+        Terms are essential while the sum of maximum scores of the remaining terms is not less than
+        the current top_n-th score (a document that is found only by the remaining terms could still get into
+        the top), their posting lists are read entirely. The remaining terms are non-essential: new documents
+        can't get into the result, so their posting lists are only searched (binary search) for the candidates
+        that have been found already, and before every list the candidates that can't reach the top_n-th score
+        even with the maximum scores of all remaining terms are dropped
+        Args:
+            lemmatized_query: string of lemmatized query
+            top_n: number of relevant documents in the result
+            mask: boolean mask of documents that can be found (None - all documents)
+
+        Returns: positions of found documents and their scores
+        """
+        with stage('vectorize'):
+            terms = np.array(sorted({self._vocabulary[w] for w in lemmatized_query.split() if w in self._vocabulary}),
+                             dtype=np.int64)
+            terms = terms[np.argsort(-self._max_scores[terms], kind='stable')]
+            remaining = np.cumsum(self._max_scores[terms][::-1], dtype=np.float64)[::-1]
+            remaining = np.append(remaining[1:], 0)  # максимально возможная добавка от еще не обработанных терминов
+
+        with stage('score'):  # отсечение по порогу top_n входит в подсчет
+            docs, acc = self.accumulate_scores(terms, remaining, top_n, mask)
+        with stage('top_k'):
+            rank = self.top_k(acc, top_n)
+        return docs[rank], acc[rank]
+
+    def accumulate_scores(self,
+                          terms: np.ndarray,
+                          remaining: np.ndarray,
+                          top_n: int,
+                          mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Main loop of MaxScore (see max_score_top_k): scores from the posting lists of essential terms are added
+        to the dense accumulator, then the candidates are looked up in the posting lists of non-essential terms
+        Args:
+            terms: query terms in the order of decreasing maximum score
+            remaining: maximum score that documents can still get after each term
+            top_n: number of relevant documents in the result
+            mask: boolean mask of documents that can be found (None - all documents)
+
+        Returns: sorted positions of documents that can get into the top and their accumulated scores
+        """
+        acc = np.zeros(len(self.doc_idx), dtype=np.float64)
+        seen = np.zeros(len(self.doc_idx), dtype=bool)
+        docs = np.empty(0, dtype=np.int32)
+        threshold = -np.inf
+        n_essential = len(terms)
+        for i, term in enumerate(terms):
+            start, end = self._indptr[term], self._indptr[term + 1]
+            term_docs, term_scores = self._postings[start:end], self._scores[start:end]
+            if mask is not None:
+                allowed = mask[term_docs]
+                term_docs, term_scores = term_docs[allowed], term_scores[allowed]
+            acc[term_docs] += term_scores  # внутри списка документы не повторяются
+            new_docs = term_docs[~seen[term_docs]]
+            seen[new_docs] = True
+            docs = np.concatenate([docs, new_docs])
+            if 0 < top_n < len(docs):
+                threshold = np.partition(acc[docs], -top_n)[-top_n]
+                if remaining[i] < threshold:
+                    n_essential = i + 1
+                    break
+
+        docs = np.sort(docs)
+        acc = acc[docs]
+        for i in range(n_essential, len(terms)):
+            # документы, которые не наберут порог даже с максимальными оценками оставшихся терминов
+            candidates = acc + remaining[i - 1] >= threshold
+            docs, acc = docs[candidates], acc[candidates]
+            start, end = self._indptr[terms[i]], self._indptr[terms[i] + 1]
+            term_docs = self._postings[start:end]
+            if not len(term_docs):
+                continue
+            pos = np.minimum(np.searchsorted(term_docs, docs), len(term_docs) - 1)
+            hit = term_docs[pos] == docs
+            acc[hit] += self._scores[start + pos[hit]]
+            if top_n < len(docs):
+                threshold = np.partition(acc, -top_n)[-top_n]
+        return docs, acc
+
+    def rank_documents(self, lemmatized_query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
+        return self.score_documents(lemmatized_query, top_n, filters)[0]
+
+    def score_documents(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        rows = self.candidate_rows(filters)
+        mask = None if rows is None else self.metadata.mask(rows)
+        positions, scores = self.max_score_top_k(lemmatized_query, top_n, mask)
+        return self.doc_idx[positions].tolist(), scores.tolist()
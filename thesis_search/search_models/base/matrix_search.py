@@ -1,10 +1,12 @@
-from typing import Iterable, Tuple, Dict
+from typing import Iterable, Tuple, Dict, List, Any
 
 import numpy as np
 import pandas as pd
 from scipy.sparse import csr_array
 
+from .index_store import IndexStore
 from .search_engine import BaseSearch
+from ...utils.metrics import stage
 
 
 class MatrixSearch(BaseSearch):
@@ -13,11 +15,15 @@ class MatrixSearch(BaseSearch):
     Attributes:
         index: index in the form of sparse matrix
         _vocabulary: mapping of terms to feature indices
+        _doc_term_count: document-term matrix filled with term counts (needed to add new documents)
     """
+    supports_incremental = True
+
     def __init__(self, corpus: pd.DataFrame):
         super().__init__(corpus)
         self._index = None
         self._vocabulary = None
+        self._doc_term_count = None
 
     @property
     def index(self):
@@ -31,11 +37,13 @@ class MatrixSearch(BaseSearch):
         self._index = index_matrix
 
     @staticmethod
-    def extract_features(docs: Iterable[str]) -> Tuple[csr_array, Dict[str, int]]:
+    def extract_features(docs: Iterable[str],
+                         vocabulary: Dict[str, int] = None) -> Tuple[csr_array, Dict[str, int]]:
         """
         Convert a collection of text documents to a matrix of term counts.
         Args:
             docs: sequence of texts
+            vocabulary: existing vocabulary that should be extended with new terms (is not modified)
 
         Returns: index, vocabulary
             index: document-term matrix
@@ -44,7 +52,7 @@ class MatrixSearch(BaseSearch):
         """
         indptr = [0]  # куммулятивная сумма ненулевых элементов для каждой строки
         indices = []  # индексы столбцов, где хранятся ненулевые элементы (столбцы - термины)
-        vocabulary = {}  # {слово: индекс признака}
+        vocabulary = {} if vocabulary is None else dict(vocabulary)  # {слово: индекс признака}
         data = []
         for doc in docs:
             for w in doc.split():
@@ -52,9 +60,85 @@ class MatrixSearch(BaseSearch):
                 indices.append(feature_index)
                 data.append(1)
             indptr.append(len(indices))
-        index = csr_array((data, indices, indptr), dtype=int)
+        index = csr_array((data, indices, indptr), shape=(len(indptr) - 1, len(vocabulary)), dtype=int)
+        index.sum_duplicates()
         return index, vocabulary
 
+    @staticmethod
+    def stack_rows(top: csr_array, bottom: csr_array) -> csr_array:
+        """
+        Stacks two document-term matrices vertically, top matrix can have fewer columns (smaller vocabulary)
+        Args:
+            top: matrix with shape = (n_docs_1, vocab_size_1)
+            bottom: matrix with shape = (n_docs_2, vocab_size_2), vocab_size_2 >= vocab_size_1
+
+        Returns: matrix with shape = (n_docs_1 + n_docs_2, vocab_size_2)
+        """
+        data = np.concatenate([top.data, bottom.data])
+        indices = np.concatenate([top.indices, bottom.indices])
+        indptr = np.concatenate([top.indptr, bottom.indptr[1:] + top.indptr[-1]])
+        return csr_array((data, indices, indptr), shape=(top.shape[0] + bottom.shape[0], bottom.shape[1]))
+
+    def weigh(self, doc_term_count: csr_array) -> csr_array:
+        """
+        Transforms matrix of term counts into the index (by default counts are used as they are)
+        Args:
+            doc_term_count: document-term matrix filled with term counts
+
+        Returns: document-term matrix filled with metric values
+        """
+        return doc_term_count
+
+    def build_index(self):
+        self._doc_term_count, self._vocabulary = self.extract_features(self.text)
+        self.index = self.weigh(self._doc_term_count)
+
+    def index_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            **IndexStore.vocabulary_to_arrays(self._vocabulary),
+            'counts_data': self._doc_term_count.data,
+            'counts_indices': self._doc_term_count.indices,
+            'counts_indptr': self._doc_term_count.indptr,
+            'index_data': self._index.data,
+            'index_indices': self._index.indices,
+            'index_indptr': self._index.indptr,
+            'shape': np.array(self._index.shape),
+            'ids': self.doc_idx.to_numpy(),
+            'hashes': self.text_hashes(self.text)
+        }
+
+    def restore_index(self, arrays: Dict[str, np.ndarray]):
+        self.doc_idx = pd.Series(np.asarray(arrays['ids']), name=self.doc_idx.name)
+        shape = tuple(arrays['shape'].tolist())
+        self._vocabulary = IndexStore.arrays_to_vocabulary(arrays)
+        self._doc_term_count = csr_array(
+            (arrays['counts_data'], arrays['counts_indices'], arrays['counts_indptr']), shape=shape
+        )
+        self.index = csr_array((arrays['index_data'], arrays['index_indices'], arrays['index_indptr']), shape=shape)
+
+    def add_documents(self, corpus: pd.DataFrame):
+        """
+        Adds term counts of new documents to the document-term matrix and recomputes index values
+        (so that document frequencies and average length are updated). If texts of indexed documents changed,
+        the index is rebuilt from the corpus
+        """
+        ids, texts = [corpus[col] for col in corpus.columns]
+        if len(self.changed_rows(corpus)):
+            self.doc_idx, self.text = ids.reset_index(drop=True), texts.reset_index(drop=True)
+            self.build_index()
+            self.save_updated_index()
+            return
+        new = ~ids.isin(self.doc_idx)
+        if not new.any():
+            return
+        ids, texts = ids[new].reset_index(drop=True), texts[new].reset_index(drop=True)
+        doc_term_count, self._vocabulary = self.extract_features(texts, self._vocabulary)
+        self._doc_term_count = self.stack_rows(self._doc_term_count, doc_term_count)
+        self.doc_idx = pd.concat([self.doc_idx, ids], ignore_index=True)
+        self.text = pd.concat([self.text, texts], ignore_index=True)
+        self.index = self.weigh(self._doc_term_count)
+        self.save_updated_index()
+
     def vectorize_query(self, query: str) -> np.ndarray:
         """
         Transforms query into vector of size (vocab_size, 1), where 1 means that word is in the query
@@ -67,14 +151,45 @@ class MatrixSearch(BaseSearch):
         """
         query_idx = []
         for w in query.split():
-            if self._vocabulary.get(w):
+            if w in self._vocabulary:
                 query_idx.append(self._vocabulary[w])
         vector = np.zeros((self._index.shape[1], 1))
         vector[query_idx] = 1
         return vector
 
-    def rank_documents(self, lemmatized_query: str, top_n: int) -> Iterable[int]:
-        query_vector = self.vectorize_query(lemmatized_query)
-        scores = self._index @ query_vector
-        rank = (-scores).argsort(axis=0)[:, 0]
-        return self.doc_idx[rank][:top_n].tolist()
+    def vectorize_queries(self, queries: List[str]) -> csr_array:
+        """
+        Transforms queries into sparse matrix of size (vocab_size, n_queries), column j is the vector of j-th query
+        Args:
+            queries: lemmatized queries in the form of strings
+
+        Returns: queries matrix
+        """
+        rows, cols = [], []
+        for j, query in enumerate(queries):
+            query_idx = {self._vocabulary[w] for w in query.split() if w in self._vocabulary}
+            rows.extend(query_idx)
+            cols.extend([j] * len(query_idx))
+        return csr_array((np.ones(len(rows)), (rows, cols)), shape=(self._index.shape[1], len(queries)))
+
+    def rank_documents(self, lemmatized_query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
+        return self.score_documents(lemmatized_query, top_n, filters)[0]
+
+    def score_documents(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        with stage('vectorize'):
+            query_vector = self.vectorize_query(lemmatized_query)
+        rows = self.candidate_rows(filters)
+        with stage('score'):
+            index = self._index if rows is None else self._index[rows]  # только строки документов, прошедших фильтры
+            scores = np.asarray(index @ query_vector).reshape(-1)
+        with stage('top_k'):
+            top = self.top_k(scores, top_n)
+        rank = top if rows is None else rows[top]
+        return self.doc_idx[rank].tolist(), scores[top].tolist()
+
+    def rank_documents_batch(self, lemmatized_queries: List[str], top_n: int) -> List[List[int]]:
+        scores = self._index @ self.vectorize_queries(lemmatized_queries)  # (n_docs, n_queries)
+        return [self.doc_idx[rank].tolist() for rank in self.top_k_sparse_columns(scores, top_n)]
@@ -0,0 +1,75 @@
+from typing import Dict, Iterable, Tuple, Any, Optional, List
+
+import numpy as np
+
+
+class MetadataIndex:
+    """
+    Positions of documents (rows of the engine's doc_idx) for every value of every metadata field,
+    so filtered search can score only candidate rows
+    Attributes:
+        n_docs: number of documents in the engine
+        index: {field: {value: sorted array of document positions}}
+    """
+    fields = ('year', 'program', 'supervisor')
+
+    def __init__(self, doc_idx: Iterable[int], metadata: Dict[str, Iterable[Tuple[int, Any]]]):
+        """
+        Args:
+            doc_idx: ids of documents in the order of engine's rows
+            metadata: {field: [(document id, value), ...]}, documents that are not in doc_idx are ignored
+        """
+        doc_idx = np.asarray(doc_idx)
+        self.n_docs = len(doc_idx)
+        order = np.argsort(doc_idx, kind='stable')
+        sorted_ids = doc_idx[order]
+
+        self.index: Dict[str, Dict[Any, np.ndarray]] = {}
+        for field in self.fields:
+            rows = list(metadata.get(field, []))
+            ids = np.array([thesis_id for thesis_id, _ in rows], dtype=sorted_ids.dtype)
+            values = np.array([value for _, value in rows], dtype=object)
+            pos = np.searchsorted(sorted_ids, ids)
+            found = pos < len(sorted_ids)
+            found[found] = sorted_ids[pos[found]] == ids[found]
+            positions, values = order[pos[found]], values[found]
+
+            field_index = {}
+            for position, value in zip(positions, values):
+                field_index.setdefault(value, []).append(position)
+            self.index[field] = {value: np.unique(p) for value, p in field_index.items()}
+
+    def values(self, field: str) -> List[Any]:
+        return sorted(self.index[field])
+
+    def positions(self, filters: Dict[str, Any]) -> Optional[np.ndarray]:
+        """
+        Finds documents that satisfy all filters (and any of the values inside one filter)
+        Args:
+            filters: {field: value or list of values}, empty values are ignored
+
+        Returns: sorted array of document positions or None if there are no filters
+        """
+        result = None
+        for field, values in (filters or {}).items():
+            if values is None or values == '' or values == []:
+                continue
+            if field not in self.index:
+                raise ValueError(f'Unknown filter: {field}, should be one of {self.fields}')
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            field_positions = [self.index[field].get(value) for value in values]
+            field_positions = np.unique(np.concatenate(
+                [p for p in field_positions if p is not None] or [np.empty(0, dtype=np.int64)]
+            ))
+            result = field_positions if result is None else np.intersect1d(result, field_positions,
+                                                                           assume_unique=True)
+        return result
+
+    def mask(self, positions: np.ndarray) -> np.ndarray:
+        """
+        Converts positions to boolean mask over all documents
+        """
+        mask = np.zeros(self.n_docs, dtype=bool)
+        mask[positions] = True
+        return mask
@@ -1,7 +1,15 @@
+import hashlib
+import heapq
+import os
 from abc import abstractmethod
-from typing import Iterable
+from typing import Iterable, Dict, List, Any, Union, Tuple
 
+import numpy as np
 import pandas as pd
+from scipy.sparse import csc_array
+
+from .index_store import IndexStore
+from .metadata_index import MetadataIndex
 
 
 class BaseSearch:
@@ -10,7 +18,12 @@ class BaseSearch:
     Attributes:
         doc_idx: pd.Series of document indices
         text: pd.Series of document texts
+        index_folder: folder where the index is saved (None if the index is kept only in memory)
+        metadata: positions of documents with every year, program and supervisor (needed for filters)
+        supports_incremental: whether new documents can be added with add_documents (otherwise the index is rebuilt)
     """
+    supports_incremental = False
+
     def __init__(self, corpus: pd.DataFrame):
         """
         Loads corpus
@@ -18,15 +31,245 @@ class BaseSearch:
             corpus: pandas dataframe with two columns - 1st documents' indices, 2nd - documents' texts
         """
         self.doc_idx, self.text = [corpus[col] for col in corpus.columns]
+        self.index_folder = None
+        self.metadata: MetadataIndex = None
+
+    @staticmethod
+    def fingerprint(corpus: pd.DataFrame) -> str:
+        """
+        Hash of the corpus contents (ids and texts in their order)
+        """
+        return hashlib.sha1(pd.util.hash_pandas_object(corpus, index=False).to_numpy().tobytes()).hexdigest()
+
+    @staticmethod
+    def text_hashes(texts: Iterable[str]) -> np.ndarray:
+        """
+        Hash of every text (saved with the index to find documents whose texts changed, e.g. after lemmatize)
+        Returns: array of uint64 hashes, shape = (n_docs, )
+        """
+        return pd.util.hash_pandas_object(pd.Series(texts, dtype=object), index=False).to_numpy()
+
+    @classmethod
+    def corpus_hashes(cls,
+                      ids: np.ndarray,
+                      corpus_ids: Iterable[int],
+                      corpus_texts: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds texts of documents with the given ids in the corpus
+        Returns: mask of ids that are in the corpus and hashes of their texts (0 for missing documents)
+        """
+        current = pd.Series(cls.text_hashes(corpus_texts), index=np.asarray(corpus_ids))
+        found = np.isin(ids, current.index)
+        hashes = np.zeros(len(ids), dtype=np.uint64)
+        hashes[found] = current.loc[ids[found]].to_numpy()
+        return found, hashes
+
+    def changed_rows(self, corpus: pd.DataFrame) -> np.ndarray:
+        """
+        Positions of indexed documents whose texts in the corpus differ from the indexed ones
+        (documents that are not in the corpus are skipped)
+        """
+        ids, texts = [corpus[col] for col in corpus.columns]
+        found, hashes = self.corpus_hashes(np.asarray(self.doc_idx), ids, texts)
+        return np.flatnonzero(found & (hashes != self.text_hashes(self.text)))
+
+    def build_index(self):
+        """
+        Computes index for corpus documents
+        """
+        raise NotImplementedError
+
+    def index_params(self) -> Dict[str, Any]:
+        """
+        Parameters that index values depend on (saved index is rebuilt when they change)
+        """
+        return {}
+
+    def index_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Returns: arrays that are enough to restore the index, mapping of names to arrays
+            (including 'ids' - ids of indexed documents in the order of index rows)
+        """
+        raise NotImplementedError(f'{type(self).__name__} index can\'t be saved')
+
+    def restore_index(self, arrays: Dict[str, np.ndarray]):
+        """
+        Restores the index and ids of indexed documents from arrays returned by index_arrays
+        (arrays can be memory maps)
+        """
+        raise NotImplementedError(f'{type(self).__name__} index can\'t be loaded')
+
+    def index_store(self) -> IndexStore:
+        return IndexStore(self.index_folder, type(self).__name__, self.index_params())
+
+    def init_index(self, index_folder: Union[str, os.PathLike] = None):
+        """
+        Loads index saved with the same parameters or computes it and saves to the index folder.
+        Saved index is used if all its documents are still in the corpus with the same texts (hashes of indexed
+        texts are saved with the index): then it covers only documents that were indexed before, and new ones
+        should be added with add_documents. If some documents were removed or changed (for ex. lemmatized again),
+        the index is rebuilt
+        Args:
+            index_folder: folder with saved indices, if None the index is computed and kept only in memory
+        """
+        self.index_folder = index_folder
+        if index_folder is None:
+            self.build_index()
+            return
+        store = self.index_store()
+        if store.exists():
+            arrays = store.load()
+            ids = np.asarray(arrays['ids']) if 'ids' in arrays else None
+            hashes = np.asarray(arrays['hashes']) if 'hashes' in arrays else None
+            if ids is not None and hashes is not None and self.is_current(ids, hashes):
+                texts = pd.Series(np.asarray(self.text, dtype=object), index=np.asarray(self.doc_idx))
+                self.text = texts.reindex(ids).reset_index(drop=True)
+                self.restore_index(arrays)
+                return
+        self.build_index()
+        store.save(self.index_arrays())
+
+    def is_current(self, ids: np.ndarray, hashes: np.ndarray) -> bool:
+        """
+        Whether all documents of the saved index are still in the corpus with the same texts
+        """
+        found, current = self.corpus_hashes(ids, self.doc_idx, self.text)
+        return bool(found.all()) and np.array_equal(current, hashes)
+
+    def save_updated_index(self):
+        """
+        Saves the index after adding new documents (if the index is stored on disk)
+        """
+        if self.index_folder is not None:
+            self.index_store().save(self.index_arrays())
 
     @abstractmethod
-    def rank_documents(self, lemmatized_query: str, top_n: int) -> Iterable[int]:
+    def rank_documents(self, lemmatized_query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
         """
         Method that ranges documents by relevance to the query
         Args:
             lemmatized_query: string of lemmatized query
             top_n: number of relevant documents in the result
+            filters: metadata filters {field: value or list of values} (see MetadataIndex),
+                only documents that satisfy them are scored
 
         Returns: list of indices of relevant documents
         """
         ...
+
+    @abstractmethod
+    def score_documents(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        """
+        Same as rank_documents, but also returns scores of found documents (needed to combine engines)
+        Args:
+            lemmatized_query: string of lemmatized query
+            top_n: number of relevant documents in the result
+            filters: metadata filters {field: value or list of values}
+
+        Returns: list of indices of relevant documents and list of their scores
+        """
+        ...
+
+    def candidate_rows(self, filters: Dict[str, Any] = None) -> np.ndarray:
+        """
+        Positions of documents that satisfy filters
+        Returns: sorted array of positions in doc_idx or None if there are no filters
+        """
+        if not filters:
+            return None
+        if self.metadata is None:
+            raise ValueError(f'{type(self).__name__} has no metadata index, filters can\'t be applied')
+        return self.metadata.positions(filters)
+
+    def add_documents(self, corpus: pd.DataFrame):
+        """
+        Adds documents that are not in the index yet without rebuilding the whole index and updates documents
+        whose texts changed (implemented by engines with supports_incremental = True)
+        Args:
+            corpus: pandas dataframe with two columns - 1st documents' indices, 2nd - documents' texts
+        """
+        raise NotImplementedError(f'{type(self).__name__} can only be rebuilt from scratch')
+
+    def rank_documents_batch(self, lemmatized_queries: List[str], top_n: int) -> List[List[int]]:
+        """
+        Ranges documents for many queries at once. Engines that can score all queries with one
+        matrix product override this method, by default queries are ranked one by one
+        Args:
+            lemmatized_queries: list of lemmatized queries
+            top_n: number of relevant documents in the result for each query
+
+        Returns: list of lists of indices of relevant documents (one list per query)
+        """
+        return [self.rank_documents(query, top_n) for query in lemmatized_queries]
+
+    @staticmethod
+    def top_k(scores: np.ndarray, k: int, skip_zeros: bool = True) -> np.ndarray:
+        """
+        Selects positions of k documents with the highest scores without sorting the whole array:
+        k-th largest value is found with partition and only survivors are sorted. Ties are broken by
+        document position in the corpus, so the result is deterministic
+        Args:
+            scores: document scores, any shape that flattens to (n_docs, )
+            k: number of documents to select
+            skip_zeros: whether documents with zero score (that don't match the query at all) are dropped
+
+        Returns: positions of selected documents sorted by decreasing score
+        """
+        scores = np.asarray(scores).reshape(-1)
+        valid = ~np.isnan(scores)
+        if skip_zeros:
+            valid &= scores != 0
+        candidates = np.flatnonzero(valid)
+        if k <= 0 or candidates.size == 0:
+            return np.empty(0, dtype=int)
+
+        candidate_scores = scores[candidates]
+        if k < candidates.size:
+            kth_score = np.partition(candidate_scores, -k)[-k]
+            above = np.flatnonzero(candidate_scores > kth_score)
+            ties = np.flatnonzero(candidate_scores == kth_score)[:k - above.size]
+            survivors = np.concatenate([above, ties])
+            candidates, candidate_scores = candidates[survivors], candidate_scores[survivors]
+
+        order = np.lexsort((candidates, -candidate_scores))
+        return candidates[order]
+
+    @classmethod
+    def top_k_sparse_columns(cls, scores, k: int) -> List[np.ndarray]:
+        """
+        Selects top k rows for every column of the sparse score matrix looking only at its non-zero elements
+        Args:
+            scores: sparse matrix with shape = (n_docs, n_queries)
+            k: number of documents to select for each query
+
+        Returns: list of arrays with positions of selected documents (one per query)
+        """
+        scores = csc_array(scores)
+        scores.sum_duplicates()  # заодно сортирует индексы, чтобы при равенстве выигрывал документ с меньшей позицией
+        result = []
+        for j in range(scores.shape[1]):
+            start, end = scores.indptr[j], scores.indptr[j + 1]
+            positions = scores.indices[start:end]
+            result.append(positions[cls.top_k(scores.data[start:end], k)])
+        return result
+
+    @staticmethod
+    def top_k_dict(scores: Dict[int, float], k: int, skip_zeros: bool = True) -> Iterable[int]:
+        """
+        Selects k documents with the highest scores from the dictionary using heap.
+        Ties are broken by the smaller document index
+        Args:
+            scores: dictionary {doc_idx: score}
+            k: number of documents to select
+            skip_zeros: whether documents with zero score are dropped
+
+        Returns: list of document indices sorted by decreasing score
+        """
+        items = scores.items()
+        if skip_zeros:
+            items = ((doc, score) for doc, score in items if score != 0)
+        best = heapq.nsmallest(k, items, key=lambda x: (-x[1], x[0]))
+        return [doc for doc, _ in best]
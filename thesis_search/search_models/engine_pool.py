@@ -0,0 +1,134 @@
+import os
+import threading
+from typing import Dict, Any, Iterable, Optional, Union
+
+from ..utils.database import DBHandler
+from .search_engine import SearchEngine
+
+
+class EnginePool:
+    """
+    Search engines that are constructed on first use (or in the background warm-up thread).
+    Every engine has its own lock, so while one engine is loading, engines that are already
+    loaded keep serving queries
+    Attributes:
+        index_types: index types that can be loaded
+        engines: loaded engines in the form of {index_type: SearchEngine}
+        errors: exceptions raised while loading engines in the form of {index_type: exception}
+    """
+    def __init__(self,
+                 index_types: Iterable[str],
+                 index_folder: Union[str, os.PathLike],
+                 data_retriever: DBHandler,
+                 defaults: Dict[str, Dict[str, Any]],
+                 download: bool = True):
+        """
+        Args:
+            index_types: index types that can be loaded
+            index_folder: folder with precomputed indices
+            data_retriever: database handler
+            defaults: default settings of every index type (defaults section of the config)
+            download: whether missing vector models should be downloaded
+        """
+        self.index_types = list(index_types)
+        self.index_folder = index_folder
+        self.db = data_retriever
+        self.defaults = defaults
+        self.download = download
+
+        self.engines: Dict[str, SearchEngine] = {}
+        self.errors: Dict[str, Exception] = {}
+        self._loading = set()
+        self._locks = {idx_type: threading.Lock() for idx_type in self.index_types}
+
+    def create(self, idx_type: str) -> SearchEngine:
+        if self.download and idx_type in SearchEngine.downloadable:
+            SearchEngine.download_model(idx_type,
+                                        self.defaults[idx_type]['model_path'],
+                                        self.defaults[idx_type]['source_link'])
+        return SearchEngine(
+            index_type=idx_type,
+            implementation=self.defaults[idx_type]['implementation'],
+            index_folder=self.index_folder,
+            data_retriever=self.db,
+            defaults=self.defaults[idx_type],
+            preprocessor=self.defaults[idx_type]['preprocessor_']
+        )
+
+    def load(self, idx_type: str) -> SearchEngine:
+        """
+        Returns engine of the index type, constructs it if it's not loaded yet (blocks until it's loaded)
+        """
+        if idx_type not in self._locks:
+            raise KeyError(f'Unknown index type: {idx_type}')
+        with self._locks[idx_type]:
+            if idx_type in self.engines:
+                return self.engines[idx_type]
+            self._loading.add(idx_type)
+            self.errors.pop(idx_type, None)
+            try:
+                engine = self.create(idx_type)
+            except Exception as e:
+                self.errors[idx_type] = e
+                raise
+            finally:
+                self._loading.discard(idx_type)
+            self.engines[idx_type] = engine
+            return engine
+
+    def get(self, idx_type: str, wait: bool = True) -> Optional[SearchEngine]:
+        """
+        Returns engine of the index type
+        Args:
+            idx_type: index type
+            wait: if False and the engine is not loaded yet, loading is started in the background
+                and None is returned instead of waiting
+
+        Returns: search engine or None if it's still loading
+        """
+        engine = self.engines.get(idx_type)
+        if engine is not None:
+            return engine
+        if wait:
+            return self.load(idx_type)
+        if idx_type not in self._locks:
+            raise KeyError(f'Unknown index type: {idx_type}')
+        if idx_type not in self._loading:
+            self.start(self._load_quietly, idx_type)
+        return None
+
+    def _load_quietly(self, *index_types: str):
+        for idx_type in index_types:
+            try:
+                self.load(idx_type)
+            except Exception:  # ошибка сохраняется в self.errors и видна в status()
+                pass
+
+    @staticmethod
+    def start(target, *args) -> threading.Thread:
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def warm_up(self) -> threading.Thread:
+        """
+        Loads all engines one by one in the background thread
+        Returns: warm-up thread
+        """
+        return self.start(self._load_quietly, *self.index_types)
+
+    def status(self) -> Dict[str, str]:
+        """
+        Returns: state of every engine: "ready", "loading", "not loaded" or "failed: <error>"
+        """
+        states = {}
+        for idx_type in self.index_types:
+            if idx_type in self.engines:
+                states[idx_type] = 'ready'
+            elif idx_type in self._loading:
+                states[idx_type] = 'loading'
+            elif idx_type in self.errors:
+                states[idx_type] = f'failed: {self.errors[idx_type]!r}'
+            else:
+                states[idx_type] = 'not loaded'
+        return states
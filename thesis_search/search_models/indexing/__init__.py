@@ -1,5 +1,32 @@
-from .bert_index import *
-from .bm25_index import *
-from .fasttext_index import *
-from .freq_index import *
-from .word2vec_index import *
+"""
+Search engines are imported only when they are used, so that heavy backends (torch, transformers,
+gensim, fasttext) are not loaded for index types that are not configured
+"""
+from importlib import import_module
+
+_modules = {
+    'BertIndex': 'bert_index',
+    'BM25Matrices': 'bm25_index',
+    'BM25Dict': 'bm25_index',
+    'BM25Search': 'bm25_index',
+    'BM25Inverted': 'bm25_index',
+    'FastTextSearch': 'fasttext_index',
+    'CountVectSearch': 'freq_index',
+    'FreqDict': 'freq_index',
+    'FreqMatrix': 'freq_index',
+    'FreqInverted': 'freq_index',
+    'Word2VecSearch': 'word2vec_index',
+    'HybridSearch': 'hybrid_index',
+}
+
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(import_module(f'.{_modules[name]}', __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
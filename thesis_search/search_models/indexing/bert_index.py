@@ -2,7 +2,6 @@ __all__ = ['BertIndex']
 
 import os
 from typing import Union, List
-from pathlib import Path
 
 import pandas as pd
 from transformers import AutoTokenizer, AutoModel
@@ -12,6 +11,7 @@ from tqdm import tqdm
 from spacy.language import Language
 
 from ..base.embedding_search import EmbeddingSearch
+from ...utils.metrics import stage
 
 
 class BertIndex(EmbeddingSearch):
@@ -21,7 +21,9 @@ class BertIndex(EmbeddingSearch):
                  model_name: str,
                  model_path: str,
                  index_folder_: Union[os.PathLike, str],
-                 similarity_metric='cosine'):
+                 similarity_metric='cosine',
+                 batch_size: int = 32,
+                 docs_per_chunk: int = 256):
         """
         Class that implements search based on bert language model
         Args:
@@ -31,19 +33,18 @@ class BertIndex(EmbeddingSearch):
             model_path: the model id of a pretrained model hosted inside a model repo on huggingface.co.
             index_folder_: folder where precomputed index should be stored
             similarity_metric: either 'cosine' or 'dot-prod'
+            batch_size: number of sentences in one forward pass during indexing
+            docs_per_chunk: number of documents whose sentences are collected and sorted by length together
         """
         super().__init__(corpus, model_name, similarity_metric)
         self.model_path = model_path
         self.nlp = nlp_
+        self.batch_size = batch_size
+        self.docs_per_chunk = docs_per_chunk
 
         self.register_model()
 
-        index_path = Path(index_folder_, f'{self.model_name}_index.txt').resolve()
-        if not Path(index_path).exists():
-            self.index = self.compute_index()
-            self.save_index(index_path)
-        else:
-            self.index = self.load_index(index_path)
+        self.init_index(index_folder_)
 
     def register_model(self):
         if self.model_name not in BertIndex.loaded:
@@ -58,6 +59,10 @@ class BertIndex(EmbeddingSearch):
         else:
             BertIndex.loaded[self.model_name]['ref_count'] += 1
 
+    @property
+    def hidden_size(self) -> int:
+        return self.model.config.hidden_size
+
     @staticmethod
     def mean_pooling(model_output, attention_mask) -> torch.Tensor:
         token_embeddings = model_output[0]  # First element of model_output contains all token embeddings
@@ -75,29 +80,68 @@ class BertIndex(EmbeddingSearch):
         Returns: numpy ndarray with shape = (n_sents, emb_size)
 
         """
-        encoded_input = BertIndex.loaded[self.model_name]['tokenizer'](
-            sentences,
-            padding=True,
-            truncation=True,
-            max_length=512,
-            return_tensors='pt')  # input_ids, token_type_ids, attention_mask
-
-        with torch.no_grad():
+        with stage('tokenize'):
+            encoded_input = BertIndex.loaded[self.model_name]['tokenizer'](
+                sentences,
+                padding=True,
+                truncation=True,
+                max_length=512,
+                return_tensors='pt')  # input_ids, token_type_ids, attention_mask
+
+        with stage('forward'), torch.inference_mode():
             model_output = BertIndex.loaded[self.model_name]['model'](**encoded_input)
-        sentence_embeddings = self.mean_pooling(model_output, encoded_input['attention_mask'])
+            sentence_embeddings = self.mean_pooling(model_output, encoded_input['attention_mask'])
         return sentence_embeddings.numpy()
 
-    def compute_index(self):
+    def sentences_emb_batched(self, sentences: List[str]) -> np.ndarray:
+        """
+        Computes embeddings of many sentences: sentences are sorted by their length in tokens and
+        split into batches of batch_size, so that sentences of similar length are padded together
+        Args:
+            sentences: list of string texts
+
+        Returns: numpy ndarray with shape = (n_sents, emb_size) in the order of the input sentences
+
+        """
+        tokenizer = BertIndex.loaded[self.model_name]['tokenizer']
+        encoded = tokenizer(sentences, truncation=True, max_length=512)
+        lengths = np.array([len(ids) for ids in encoded['input_ids']])
+        order = np.argsort(lengths, kind='stable')
+
+        embeddings = np.zeros(shape=(len(sentences), self.hidden_size), dtype=np.float32)
+        with torch.inference_mode():
+            for start in range(0, len(order), self.batch_size):
+                batch_idx = order[start:start + self.batch_size]
+                batch = tokenizer.pad([{key: encoded[key][i] for key in encoded.keys()} for i in batch_idx],
+                                      return_tensors='pt')
+                model_output = self.model(**batch)
+                embeddings[batch_idx] = self.mean_pooling(model_output, batch['attention_mask']).numpy()
+        return embeddings
+
+    def compute_index(self, texts: List[str] = None):
         print('Считаю индекс через bert...')
-        index = []
-        for doc in tqdm(self.text.tolist()):
-            if len(doc) > 1:
-                sentences = [sent.text for sent in self.nlp(doc).sents]
-                doc_emb = self.sentences_emb(sentences).mean(axis=0)
-            else:
-                doc_emb = np.zeros(shape=(1024,))
-            index.append(doc_emb)
-        return np.array(index)
+        texts = self.text.tolist() if texts is None else texts
+        index = np.zeros(shape=(len(texts), self.hidden_size), dtype=np.float32)
+        for start in tqdm(range(0, len(texts), self.docs_per_chunk)):
+            chunk = [(i, doc) for i, doc in enumerate(texts[start:start + self.docs_per_chunk], start)
+                     if len(doc) > 1]  # для пустых документов остается нулевой вектор
+            sentences, owners = [], []
+            for (i, _), parsed in zip(chunk, self.nlp.pipe(doc for _, doc in chunk)):
+                doc_sentences = [sent.text for sent in parsed.sents]
+                sentences.extend(doc_sentences)
+                owners.extend([i] * len(doc_sentences))
+            if not sentences:
+                continue
+
+            owners = np.array(owners)
+            np.add.at(index, owners, self.sentences_emb_batched(sentences))
+            counts = np.bincount(owners - start, minlength=self.docs_per_chunk)[:len(index) - start]
+            non_empty = counts > 0
+            index[start:start + len(counts)][non_empty] /= counts[non_empty].reshape(-1, 1)
+        return index
 
     def vectorize(self, text: str) -> np.ndarray:
         return self.sentences_emb([text]).reshape(-1, 1)
+
+    def vectorize_batch(self, texts: List[str]) -> np.ndarray:
+        return self.sentences_emb_batched(texts).T
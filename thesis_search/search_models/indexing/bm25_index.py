@@ -1,16 +1,20 @@
-__all__ = ['BM25Matrices', 'BM25Dict', 'BM25Search']
+__all__ = ['BM25Matrices', 'BM25Dict', 'BM25Search', 'BM25Inverted']
 
+import os
 from collections import defaultdict
 from math import log
-from typing import Dict, Iterable
+from typing import Dict, Iterable, Union, Tuple, List, Any
 
 import numpy as np
 import pandas as pd
 from rank_bm25 import BM25Okapi
+from scipy.sparse import csr_array
 
 from ..base.search_engine import BaseSearch
 from ..base.matrix_search import MatrixSearch
 from ..base.dict_search import DictSearch
+from ..base.inverted_search import InvertedSearch
+from ...utils.metrics import stage
 
 
 class BM25Matrices(MatrixSearch):
@@ -21,46 +25,53 @@ class BM25Matrices(MatrixSearch):
         index: bm25 index
         _vocabulary: mapping of terms to feature indices
     """
-    def __init__(self, corpus: pd.DataFrame, k: float = 2, b: float = 0.75):
+    def __init__(self, corpus: pd.DataFrame, k: float = 2, b: float = 0.75,
+                 index_folder: Union[str, os.PathLike] = None):
         super().__init__(corpus)
         self.k = k
         self.b = b
 
-        doc_term_count, self._vocabulary = self.extract_features(self.text)
-        doc_term_count = doc_term_count.toarray()
-        self.index = self.compute_bm25(doc_term_count, self.k, self.b)
+        self.init_index(index_folder)
+
+    def index_params(self) -> Dict[str, float]:
+        return {'k': self.k, 'b': self.b}
+
+    def weigh(self, doc_term_count: csr_array) -> csr_array:
+        return self.compute_bm25(doc_term_count, self.k, self.b)
 
     @staticmethod
-    def compute_bm25(doc_term_count: np.ndarray, k: float, b: float) -> np.ndarray:
+    def compute_bm25(doc_term_count: csr_array, k: float, b: float) -> csr_array:
         """
-        Computes bm25 value for every pair (term, doc) in the corpus
+        Computes bm25 value for every pair (term, doc) in the corpus. Only non-zero elements of
+        the matrix are touched, so the cost is linear in the number of postings
         Args:
-            doc_term_count: document-term matrix (shape=(n_docs, vocab_size)) filled with frequency
+            doc_term_count: sparse document-term matrix (shape=(n_docs, vocab_size)) filled with frequency
                 of the term in the document
             k: free parameter in bm25 formula
             b: free parameter in bm25 formula
 
-        Returns: document-term matrix (shape=(n_docs, vocab_size)) filled with bm25(term, doc) values
+        Returns: sparse document-term matrix (shape=(n_docs, vocab_size)) filled with bm25(term, doc) values
         """
-        N = doc_term_count.shape[0]
+        tf = csr_array(doc_term_count, dtype=float, copy=True)  # без копии sum_duplicates испортит исходную матрицу
+        tf.sum_duplicates()
+        N, vocab_size = tf.shape
+        rows = np.repeat(np.arange(N), np.diff(tf.indptr))  # номер документа для каждого ненулевого элемента
 
-        tf = doc_term_count.astype(float)
-        doc_lens = np.sum(doc_term_count, axis=1).reshape(-1, 1)  # (n_docs, 1)
-        non_empty_docs = (doc_lens != 0)[:, 0]  # чтобы не делить на ноль для пустых документов
-        tf[non_empty_docs, :] = tf[non_empty_docs, :] / doc_lens[non_empty_docs, :]
+        doc_lens = np.asarray(tf.sum(axis=1)).reshape(-1)  # (n_docs, )
+        tf.data /= doc_lens[rows]  # у пустых документов нет ненулевых элементов, деления на ноль не будет
 
-        df = np.count_nonzero(tf, axis=0)  # (vocab_size,)
-        idf = np.log(N) - np.log(df)  # (vocab_size, )
+        df = np.bincount(tf.indices, minlength=vocab_size)  # (vocab_size,)
+        idf = np.log(N) - np.log(np.maximum(df, 1))  # (vocab_size, )
 
-        docs_len = tf.sum(axis=1)  # (n_docs, )
+        docs_len = np.asarray(tf.sum(axis=1)).reshape(-1)  # (n_docs, )
         avg_len = docs_len.mean()
 
-        numerator = tf * (k + 1)  # (n_docs, vocab_size)
-        denom_summand = k * (1 - b + b * docs_len / avg_len).reshape(-1, 1)  # (n_docs, 1)
-        denominator = tf + denom_summand  # (n_docs, vocab_size)
+        numerator = tf.data * (k + 1)  # (nnz, )
+        denom_summand = k * (1 - b + b * docs_len / avg_len)  # (n_docs, )
+        denominator = tf.data + denom_summand[rows]  # (nnz, )
 
-        bm25_index = idf * numerator / denominator  # (n_docs, vocab_size)
-        return bm25_index
+        bm25_data = idf[tf.indices] * numerator / denominator  # (nnz, )
+        return csr_array((bm25_data, tf.indices, tf.indptr), shape=tf.shape)
 
 
 class BM25Dict(DictSearch):
@@ -129,10 +140,49 @@ class BM25Search(BaseSearch):
     """
     def __init__(self, corpus: pd.DataFrame):
         super().__init__(corpus)
-        self.doc_idx = self.doc_idx.tolist()
+        self.doc_idx = self.doc_idx.to_numpy()
         tokenized_corpus = [doc.split(" ") for doc in self.text]
         self._bm25 = BM25Okapi(tokenized_corpus)
 
-    def rank_documents(self, lemmatized_query: str, top_n: int) -> Iterable[int]:
+    def rank_documents(self, lemmatized_query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
+        return self.score_documents(lemmatized_query, top_n, filters)[0]
+
+    def score_documents(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
         tokenized_query = lemmatized_query.split(" ")
-        return self._bm25.get_top_n(tokenized_query, self.doc_idx, top_n)
+        rows = self.candidate_rows(filters)
+        if rows is None:
+            with stage('score'):
+                scores = self._bm25.get_scores(tokenized_query)
+            with stage('top_k'):
+                rank = self.top_k(scores, top_n)
+            return self.doc_idx[rank].tolist(), scores[rank].tolist()
+        with stage('score'):
+            scores = np.asarray(self._bm25.get_batch_scores(tokenized_query, rows.tolist()))
+        with stage('top_k'):
+            top = self.top_k(scores, top_n)
+        return self.doc_idx[rows[top]].tolist(), scores[top].tolist()
+
+
+class BM25Inverted(InvertedSearch):
+    """
+    BM25 index stored as compact posting lists (int32 document positions and float32 scores)
+    and searched with MaxScore pruning
+    Attributes:
+        k, b: free parameters of bm25 formula
+    """
+    def __init__(self, corpus: pd.DataFrame, k: float = 2, b: float = 0.75,
+                 index_folder: Union[str, os.PathLike] = None):
+        super().__init__(corpus)
+        self.k = k
+        self.b = b
+
+        self.init_index(index_folder)
+
+    def index_params(self) -> Dict[str, float]:
+        return {'k': self.k, 'b': self.b}
+
+    def weigh(self, doc_term_count: csr_array) -> csr_array:
+        return BM25Matrices.compute_bm25(doc_term_count, self.k, self.b)
@@ -6,14 +6,14 @@ import shutil
 import tempfile
 import urllib.request
 from pathlib import Path
-from typing import Union
+from typing import Union, List
 
-import fasttext
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from ..base.embedding_search import EmbeddingSearch
+from ..base.fasttext_vectors import FastTextVectors
 from ...utils.models import MyProgressBar
 from ... import HOME_PATH
 
@@ -25,7 +25,10 @@ class FastTextSearch(EmbeddingSearch):
                  model_name_: str,
                  model_path: Union[str, os.PathLike],
                  index_folder_: Union[str, os.PathLike],
-                 similarity_metric='cosine'):
+                 similarity_metric='cosine',
+                 serving: str = 'full',
+                 lite_vocab_top_n: int = 200000,
+                 lite_dtype: str = 'float16'):
         """
         Class that implements search based on fasttext language model
         Args:
@@ -34,18 +37,23 @@ class FastTextSearch(EmbeddingSearch):
             model_path: path to vector model file
             index_folder_: folder where precomputed index should be stored
             similarity_metric: either 'cosine' or 'dot-prod'
+            serving: 'full' - load the whole fasttext model, 'lite' - load only exported word vectors and n-gram
+                buckets as memory maps (see FastTextVectors), the full model is loaded only to export them
+            lite_vocab_top_n: number of the most frequent words exported for lite mode (other words get vectors
+                from n-grams)
+            lite_dtype: type of exported vectors: 'float16' or 'float32'
         """
         super().__init__(corpus, model_name_, similarity_metric)
+        if serving not in ('full', 'lite'):
+            raise ValueError(f'Unknown serving mode: {serving}, should be full or lite')
 
         self.model_path = model_path
+        self.serving = serving
+        self.lite_vocab_top_n = lite_vocab_top_n
+        self.lite_dtype = lite_dtype
         self.register_model()
 
-        index_path = Path(index_folder_, f'{self.model_name}_index.txt').resolve()
-        if not Path(index_path).exists():
-            self.index = self.compute_index()
-            self.save_index(index_path)
-        else:
-            self.index = self.load_index(index_path)
+        self.init_index(index_folder_)
 
     @staticmethod
     def download_model(url: str, dest_path: Union[os.PathLike, str]) -> Union[str, os.PathLike]:
@@ -71,14 +79,25 @@ class FastTextSearch(EmbeddingSearch):
 
     def load_model(self, model_path: Union[str, os.PathLike]):
         model_path = Path(model_path)
+        if self.serving == 'lite':
+            if not FastTextVectors.exists(model_path, self.lite_vocab_top_n, self.lite_dtype):
+                print(f'Экспортирую вектора {model_path.name} для легкого режима...')
+                FastTextVectors.export(self.load_full_model(model_path), model_path,
+                                       self.lite_vocab_top_n, self.lite_dtype)
+            return FastTextVectors.load(model_path, self.lite_vocab_top_n, self.lite_dtype)
+        return self.load_full_model(model_path)
+
+    @staticmethod
+    def load_full_model(model_path: Path):
         if not model_path.exists():
             raise FileNotFoundError
+        import fasttext  # не нужен в легком режиме
         return fasttext.load_model(str(model_path))
 
-    def compute_index(self) -> np.ndarray:
+    def compute_index(self, texts: List[str] = None) -> np.ndarray:
         print('Индексирую с помощью fasttext')
         index = []
-        for doc in tqdm(self.text):
+        for doc in tqdm(self.text if texts is None else texts):
             doc = doc.replace('\n', ' ')  # потому что фасттекст ругается на \n
             doc_vector = self.model.get_sentence_vector(doc)
             index.append(doc_vector)
@@ -1,6 +1,7 @@
-__all__ = ['CountVectSearch', 'FreqDict', 'FreqMatrix']
+__all__ = ['CountVectSearch', 'FreqDict', 'FreqMatrix', 'FreqInverted']
 
-from typing import Iterable, Dict, List
+import os
+from typing import Iterable, Dict, List, Union, Tuple, Any
 from collections import defaultdict
 
 import pandas as pd
@@ -9,6 +10,8 @@ from sklearn.feature_extraction.text import CountVectorizer
 from ..base.search_engine import BaseSearch
 from ..base.dict_search import DictSearch
 from ..base.matrix_search import MatrixSearch
+from ..base.inverted_search import InvertedSearch
+from ...utils.metrics import stage
 
 
 class CountVectSearch(BaseSearch):
@@ -26,12 +29,34 @@ class CountVectSearch(BaseSearch):
         self._index = vectorizer.fit_transform(self.text).transpose()
         self._vocabulary = vectorizer.vocabulary_
 
-    def rank_documents(self, lemmatized_query: str, top_n: int) -> Iterable[int]:
-        vectorizer = CountVectorizer(vocabulary=self._vocabulary, binary=True)  # для вектора запроса использую бинарный
-        query_vector = vectorizer.transform([lemmatized_query])
-        metric = (query_vector @ self._index).toarray().reshape(-1,)
-        rank = (-metric).argsort()
-        return self.doc_idx[rank][:top_n].tolist()
+    def rank_documents(self, lemmatized_query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
+        return self.score_documents(lemmatized_query, top_n, filters)[0]
+
+    def score_documents(self,
+                        lemmatized_query: str,
+                        top_n: int,
+                        filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        with stage('vectorize'):
+            vectorizer = CountVectorizer(vocabulary=self._vocabulary, binary=True)  # для вектора запроса использую бинарный
+            query_vector = vectorizer.transform([lemmatized_query])
+        rows = self.candidate_rows(filters)
+        if rows is None:
+            with stage('score'):
+                metric = (query_vector @ self._index).toarray().reshape(-1,)
+            with stage('top_k'):
+                rank = self.top_k(metric, top_n)
+            return self.doc_idx[rank].tolist(), metric[rank].tolist()
+        with stage('score'):
+            metric = (query_vector @ self._index[:, rows]).toarray().reshape(-1,)  # только столбцы-кандидаты
+        with stage('top_k'):
+            top = self.top_k(metric, top_n)
+        return self.doc_idx[rows[top]].tolist(), metric[top].tolist()
+
+    def rank_documents_batch(self, lemmatized_queries: List[str], top_n: int) -> List[List[int]]:
+        vectorizer = CountVectorizer(vocabulary=self._vocabulary, binary=True)
+        query_vectors = vectorizer.transform(lemmatized_queries)  # (n_queries, vocab_size)
+        scores = (query_vectors @ self._index).transpose()  # (n_docs, n_queries)
+        return [self.doc_idx[rank].tolist() for rank in self.top_k_sparse_columns(scores, top_n)]
 
 
 class FreqDict(DictSearch):
@@ -40,21 +65,51 @@ class FreqDict(DictSearch):
     Attributes:
         index: dictionary in form of {term: {doc_idx: frequency}}
     """
+    supports_incremental = True
+
     def __init__(self, corpus: pd.DataFrame):
         super().__init__(corpus)
         self.index = self._compute_index(self.text.tolist(), self.doc_idx)
 
     @staticmethod
-    def _compute_index(texts: Iterable[str], doc_idx: List[int]) -> Dict[str, Dict[int, int]]:
-        index = defaultdict(lambda: defaultdict(int))
+    def _compute_index(texts: Iterable[str],
+                       doc_idx: List[int],
+                       index: Dict[str, Dict[int, int]] = None) -> Dict[str, Dict[int, int]]:
+        if index is None:
+            index = defaultdict(lambda: defaultdict(int))
         for i, text in enumerate(texts):
             for w in text.split():
                 index[w][doc_idx[i]] += 1
         return index
 
+    def add_documents(self, corpus: pd.DataFrame):
+        """
+        Adds postings of new documents to the index (the index is computed again if texts of indexed documents changed)
+        """
+        ids, texts = [corpus[col] for col in corpus.columns]
+        if len(self.changed_rows(corpus)):
+            self.doc_idx, self.text = ids.tolist(), texts.reset_index(drop=True)
+            self.index = self._compute_index(self.text.tolist(), self.doc_idx)
+            return
+        known = set(self.doc_idx)
+        new = [(i, text) for i, text in zip(ids, texts) if i not in known]
+        if not new:
+            return
+        ids, texts = [i for i, _ in new], [text for _, text in new]
+        self.doc_idx.extend(ids)
+        self.text = pd.concat([self.text, pd.Series(texts)], ignore_index=True)
+        self.index = self._compute_index(texts, ids, self.index)
+
 
 class FreqMatrix(MatrixSearch):
     """Frequency index implemented through matrix"""
-    def __init__(self, corpus: pd.DataFrame):
+    def __init__(self, corpus: pd.DataFrame, index_folder: Union[str, os.PathLike] = None):
+        super().__init__(corpus)
+        self.init_index(index_folder)
+
+
+class FreqInverted(InvertedSearch):
+    """Frequency index stored as compact posting lists and searched with MaxScore pruning"""
+    def __init__(self, corpus: pd.DataFrame, index_folder: Union[str, os.PathLike] = None):
         super().__init__(corpus)
-        self._index, self._vocabulary = self.extract_features(self.text)
+        self.init_index(index_folder)
@@ -0,0 +1,97 @@
+__all__ = ['HybridSearch']
+
+from collections import defaultdict
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Tuple, Callable, Dict, Any
+
+import pandas as pd
+
+from ..base.search_engine import BaseSearch
+from ...utils.metrics import stage
+
+# один пул на все гибридные движки: пересозданные движки (например, после sync) не оставляют за собой потоков
+_executor = ThreadPoolExecutor(thread_name_prefix='hybrid')
+
+
+class HybridSearch(BaseSearch):
+    """
+    Combination of several engines (usually lexical and semantic). Every engine finds only its top candidates,
+    engines are queried concurrently (in the thread pool shared by all hybrid engines), candidate lists are merged
+    with reciprocal rank fusion (rrf) or interpolation of min-max normalized scores (interpolation)
+    Attributes:
+        engines: search models with their query preprocessors (query is passed to the hybrid engine as is)
+        weights: weight of every engine in the fused score
+        fusion: 'rrf' or 'interpolation'
+        rrf_k: constant of rrf formula: score = sum(weight / (rrf_k + rank))
+        n_candidates: number of candidates requested from every engine (at least top_n)
+    """
+    fusion_methods = ('rrf', 'interpolation')
+
+    def __init__(self,
+                 corpus: pd.DataFrame,
+                 engines: List[Tuple[BaseSearch, Callable[[str], str]]],
+                 weights: List[float] = None,
+                 fusion: str = 'rrf',
+                 rrf_k: float = 60,
+                 n_candidates: int = 100):
+        super().__init__(corpus)
+        if not engines:
+            raise ValueError('Hybrid index needs at least one engine')
+        if weights and len(weights) != len(engines):
+            raise ValueError(f'Got {len(weights)} weights for {len(engines)} engines')
+        if fusion not in self.fusion_methods:
+            raise ValueError(f'Unknown fusion method: {fusion}, should be one of {self.fusion_methods}')
+        self.engines = engines
+        self.weights = weights or [1.] * len(engines)
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.n_candidates = n_candidates
+
+    @staticmethod
+    def candidates(model: BaseSearch,
+                   preprocessor: Callable[[str], str],
+                   query: str,
+                   top_n: int,
+                   filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        with stage('preprocess'):
+            processed_query = preprocessor(query)
+        if not processed_query:  # например, в запросе нет ни одного слова из словаря
+            return [], []
+        return model.score_documents(processed_query, top_n, filters)
+
+    def rrf(self, ranks: List[List[int]]) -> Dict[int, float]:
+        fused = defaultdict(float)
+        for weight, rank in zip(self.weights, ranks):
+            for position, doc in enumerate(rank, start=1):
+                fused[doc] += weight / (self.rrf_k + position)
+        return fused
+
+    def interpolate(self, ranks: List[List[int]], scores: List[List[float]]) -> Dict[int, float]:
+        fused = defaultdict(float)
+        for weight, rank, doc_scores in zip(self.weights, ranks, scores):
+            if not rank:
+                continue
+            low, high = min(doc_scores), max(doc_scores)
+            for doc, score in zip(rank, doc_scores):
+                fused[doc] += weight * ((score - low) / (high - low) if high > low else 1.)
+        return fused
+
+    def score_documents(self, query: str, top_n: int, filters: Dict[str, Any] = None) -> Tuple[List[int], List[float]]:
+        n_candidates = max(top_n, self.n_candidates)
+        # копия контекста, чтобы время этапов движков попало в trace запроса (см. utils.metrics)
+        futures = [_executor.submit(copy_context().run, self.candidates, model, preprocessor, query,
+                                         n_candidates, filters)
+                   for model, preprocessor in self.engines]
+        ranks, scores = zip(*[future.result() for future in futures])
+        with stage('score'):
+            if self.fusion == 'rrf':
+                fused = self.rrf(ranks)
+            else:
+                fused = self.interpolate(ranks, scores)
+        with stage('top_k'):
+            rank = self.top_k_dict(fused, top_n, skip_zeros=False)  # все кандидаты что-то нашли
+        return rank, [fused[doc] for doc in rank]
+
+    def rank_documents(self, query: str, top_n: int, filters: Dict[str, Any] = None) -> Iterable[int]:
+        return self.score_documents(query, top_n, filters)[0]
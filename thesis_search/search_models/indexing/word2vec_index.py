@@ -5,7 +5,7 @@ import tempfile
 import urllib.request
 import zipfile
 from pathlib import Path
-from typing import Union, Iterable
+from typing import Union, Iterable, List
 
 import gensim
 import numpy as np
@@ -16,6 +16,7 @@ from spacy.language import Language
 from ..base.embedding_search import EmbeddingSearch
 from ... import HOME_PATH
 from ...utils.models import MyProgressBar
+from ...utils.metrics import stage
 
 
 class Word2VecSearch(EmbeddingSearch):
@@ -25,7 +26,9 @@ class Word2VecSearch(EmbeddingSearch):
                  nlp_: Language,
                  model_path: Union[str, os.PathLike],
                  index_folder_: Union[str, os.PathLike],
-                 similarity_metric='cosine'):
+                 similarity_metric='cosine',
+                 restrict_vocab: bool = False,
+                 restrict_vocab_top_n: int = 100000):
         """
         Class that implements search based on word2vec language model
         Args:
@@ -35,18 +38,18 @@ class Word2VecSearch(EmbeddingSearch):
             model_path: path to vector model file
             index_folder_: folder where precomputed index should be stored
             similarity_metric: either 'cosine' or 'dot-prod'
+            restrict_vocab: keep only vectors of words from the corpus and restrict_vocab_top_n most frequent words
+            restrict_vocab_top_n: number of the most frequent words of the model that are kept in restricted mode
+                (so that query words that are not in the corpus still have vectors)
         """
         super().__init__(corpus, model_name_, similarity_metric)
         self.nlp = nlp_
         self.model_path = model_path
+        self.restrict_vocab = restrict_vocab
+        self.restrict_vocab_top_n = restrict_vocab_top_n
         self.register_model()
 
-        index_path = Path(index_folder_, f'{model_name_}_index.txt').resolve()
-        if not Path(index_path).exists():
-            self.index = self.compute_index()
-            self.save_index(index_path)
-        else:
-            self.index = self.load_index(index_path)
+        self.init_index(index_folder_)
 
     @staticmethod
     def download_zip_model(url: str,
@@ -103,16 +106,92 @@ class Word2VecSearch(EmbeddingSearch):
         else:
             Word2VecSearch.loaded[self.model_name]['ref_count'] += 1
 
-    def load_model(self, model_path: Union[os.PathLike, str]):
+    def load_model(self, model_path: Union[os.PathLike, str]) -> gensim.models.KeyedVectors:
+        """
+        Opens the model in gensim native format (<model>.kv with vectors in <model>.kv.vectors.npy) as read-only
+        memory map, so the start is fast and all processes share one copy of vectors in the page cache.
+        The model in word2vec format is converted once. In restricted mode the reduced model
+        (<model>.restricted_<top_n>.kv) is loaded instead, it is rebuilt only when the model is converted again
+        or top_n changes. Words of the corpus that were already looked up in the full model are listed in
+        <model>.restricted_<top_n>.words.txt, vectors of new corpus words are added to the reduced model
+        Args:
+            model_path: path to the model in word2vec format (.bin - binary, otherwise text)
+
+        Returns: loaded vectors
+        """
         model_path = Path(model_path)
+        native_path = model_path.with_suffix('.kv')
+        if not native_path.exists():
+            if not model_path.exists():
+                print('no file')
+                raise FileNotFoundError(f'Can\'t find file in the specified path {str(model_path)}')
+            print(f'Конвертирую {model_path.name} в формат gensim...')
+            binary = True if model_path.suffix == '.bin' else False
+            self.save_vectors(gensim.models.KeyedVectors.load_word2vec_format(model_path, binary=binary), native_path)
+        model = gensim.models.KeyedVectors.load(str(native_path), mmap='r')
+        if not self.restrict_vocab:
+            return model
+
+        corpus_vocab = {w for text in self.text for w in text.split()}
+        restricted_path = model_path.with_suffix(f'.restricted_{self.restrict_vocab_top_n}.kv')
+        words_path = restricted_path.with_suffix('.words.txt')
+        if not restricted_path.exists() or restricted_path.stat().st_mtime < native_path.stat().st_mtime:
+            for stale in model_path.parent.glob(f'{model_path.stem}.restricted_*'):
+                stale.unlink()
+            self.save_vectors(self.restrict_model(model, corpus_vocab, self.restrict_vocab_top_n), restricted_path)
+            self.save_words(corpus_vocab, words_path)
+            return gensim.models.KeyedVectors.load(str(restricted_path), mmap='r')
+
+        checked = set(words_path.read_text(encoding='utf-8').split('\n')) if words_path.exists() else set()
+        new_words = corpus_vocab - checked
+        if new_words:
+            restricted = gensim.models.KeyedVectors.load(str(restricted_path))
+            found = self.restrict_model(model, new_words, 0)
+            missing = [key for key in found.index_to_key if key not in restricted.key_to_index]
+            if missing:
+                print(f'Добавляю в {restricted_path.name} векторов новых слов: {len(missing)}')
+                restricted.add_vectors(missing, found[missing])
+                self.save_vectors(restricted, restricted_path)
+            self.save_words(checked | new_words, words_path)
+        return gensim.models.KeyedVectors.load(str(restricted_path), mmap='r')
 
-        binary = True if model_path.suffix == '.bin' else False
+    @staticmethod
+    def restrict_model(model: gensim.models.KeyedVectors,
+                       vocabulary: set,
+                       top_n: int) -> gensim.models.KeyedVectors:
+        """
+        Keeps vectors of words from the vocabulary (with any pos label) and top_n most frequent words
+        (words of word2vec models are sorted by frequency)
+        Args:
+            model: full model
+            vocabulary: words without pos labels
+            top_n: number of the most frequent words to keep
 
-        if not model_path.exists():
-            print('no file')
-            raise FileNotFoundError(f'Can\'t find file in the specified path {str(model_path)}')
+        Returns: model with reduced vocabulary
+        """
+        keep = [i for i, key in enumerate(model.index_to_key)
+                if i < top_n or key.rsplit('_', 1)[0] in vocabulary]
+        restricted = gensim.models.KeyedVectors(model.vector_size, dtype=model.vectors.dtype)
+        restricted.add_vectors([model.index_to_key[i] for i in keep], model.vectors[keep])
+        return restricted
 
-        return gensim.models.KeyedVectors.load_word2vec_format(model_path, binary=binary)
+    @staticmethod
+    def save_words(words: set, path: Path):
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text('\n'.join(sorted(words)), encoding='utf-8')
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def save_vectors(model: gensim.models.KeyedVectors, path: Path):
+        """
+        Saves vectors in gensim native format, so that processes that are starting at the same time
+        never see partially written files (.kv file is replaced last and means that the model is complete)
+        """
+        with tempfile.TemporaryDirectory(dir=path.parent) as tmp_dir:
+            tmp_path = Path(tmp_dir, path.name)
+            model.save(str(tmp_path), sep_limit=0)  # вектора всегда в отдельном .npy, его можно открыть через mmap
+            for file in sorted(Path(tmp_dir).iterdir(), key=lambda f: f == tmp_path):
+                os.replace(file, Path(path.parent, file.name))
 
     def pos_label_text(self, text: str) -> Iterable[str]:
         """
@@ -128,10 +207,10 @@ class Word2VecSearch(EmbeddingSearch):
             labeled_text.append(w.text + '_' + w.pos_)
         return labeled_text
 
-    def compute_index(self):
+    def compute_index(self, texts: List[str] = None):
         print("Считаю индекс через w2v...")
         index = []
-        for text in tqdm(self.text):
+        for text in tqdm(self.text if texts is None else texts):
             labeled_text = self.pos_label_text(text)
             try:
                 index.append(self.model.get_mean_vector(labeled_text))
@@ -141,5 +220,6 @@ class Word2VecSearch(EmbeddingSearch):
         return index
 
     def vectorize(self, text: str) -> np.ndarray:
-        labeled_text = self.pos_label_text(text)
+        with stage('tokenize'):  # разметка частей речи spacy
+            labeled_text = self.pos_label_text(text)
         return self.model.get_mean_vector(labeled_text).reshape(-1, 1)
@@ -1,22 +1,32 @@
+import hashlib
 import os
-from functools import partial
-from typing import Union, Callable, Dict, Any
+from typing import Union, Callable, Dict, Any, List, TYPE_CHECKING
 import re
+import time
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
-import spacy
-from spacy import Language
 
+from .. import CACHE_SETTINGS, MODEL_DEFAULTS
+from ..utils.cache import ResultCache
 from ..utils.database import DBHandler
-from .indexing import *
+from ..utils.metrics import SearchMetrics, trace, stage
+from ..utils.utils import lemmatize_doc, lemmatize_texts, load_nlp, parse_bool
+from .base.search_engine import BaseSearch
+from .base.metadata_index import MetadataIndex
+from . import indexing
+
+if TYPE_CHECKING:
+    from spacy import Language
 
 
 class SearchEngine:
 
-    nlp = spacy.load("ru_core_news_sm", exclude=["ner"])
-    downloadable = {'w2v': Word2VecSearch,
-                    'ft': FastTextSearch}
+    downloadable = {'w2v': 'Word2VecSearch',
+                    'ft': 'FastTextSearch'}
+    result_cache = ResultCache(**CACHE_SETTINGS)  # общий для всех движков кэш результатов поиска
+    metrics = SearchMetrics()  # гистограммы времени этапов поиска по типам индекса
 
     def __init__(self,
                  index_type: str,
@@ -24,14 +34,82 @@ class SearchEngine:
                  index_folder: Union[str, os.PathLike],
                  data_retriever: DBHandler,
                  defaults: Dict[str, Any],
-                 preprocessor: Union[str, Callable[[str], str]] = 'lemmatize'):
+                 preprocessor: Union[str, Callable[[str], str]] = 'lemmatize',
+                 sync_on_load: bool = True):
+        """
+        Args:
+            sync_on_load: add documents that are not in the saved index yet while loading it
+                (if False, the index is used as it was saved until sync is called)
+        """
         self.db = data_retriever
+        self.sync_on_load = sync_on_load
+        self.index_type = index_type
+        self.implementation = implementation
         self.corpus = index_type
         self.index_folder = index_folder
         self.defaults = defaults
         self.preprocessor = preprocessor
 
-        self.model = self.init_model(index_type, implementation)
+        self.model = self.build_model()
+
+    def build_model(self):
+        model = self.init_model(self.index_type, self.implementation)
+        if self.defaults.get('ann', 'exact') != 'exact':
+            model.init_ann(
+                index_folder=self.index_folder,
+                method=self.defaults['ann'],
+                n_lists=int(self.defaults.get('ann_n_lists') or 0) or None,
+                nprobe=int(self.defaults.get('ann_nprobe', 8)),
+                min_docs=int(self.defaults.get('ann_min_docs', 10000))
+            )
+        if self.sync_on_load:
+            self.add_new_documents(model)
+        model.metadata = MetadataIndex(model.doc_idx, self.db.get_metadata())
+        self.invalidate_cache()
+        return model
+
+    def count_new_documents(self, model: BaseSearch) -> int:
+        """
+        Returns: number of documents of the corpus that are not in the model
+            (saved index is loaded with the documents that were indexed when it was saved)
+        """
+        return int((~self.corpus.iloc[:, 0].isin(np.asarray(model.doc_idx))).sum())
+
+    def add_new_documents(self, model: BaseSearch) -> int:
+        """
+        Adds documents of the corpus that are not in the model yet and updates documents whose texts changed
+        (model should support incremental updates)
+        Returns: number of added and updated documents
+        """
+        n_updated = self.count_new_documents(model) + len(model.changed_rows(self.corpus))
+        if n_updated:
+            model.add_documents(self.corpus)
+        return n_updated
+
+    def sync(self) -> int:
+        """
+        Rereads the corpus from the database, adds new documents to the index and updates documents whose texts
+        changed (indices that don't support incremental updates are rebuilt)
+        Returns: number of new and changed documents
+        """
+        if self.index_type == 'hybrid':
+            n_new = max(engine.sync() for engine in self.sub_engines)
+            self.model.engines = [(engine.model, engine.preprocessor) for engine in self.sub_engines]
+            self.corpus_fingerprint = self.hybrid_fingerprint()
+            self.invalidate_cache()
+            return n_new
+
+        self.corpus = self.index_type
+        if not self.model.supports_incremental:
+            n_updated = self.count_new_documents(self.model) + len(self.model.changed_rows(self.corpus))
+            if n_updated:
+                self.model = self.build_model()
+            return n_updated
+        n_updated = self.add_new_documents(self.model)
+        if n_updated:
+            self.model.metadata = MetadataIndex(self.model.doc_idx, self.db.get_metadata())
+            self.invalidate_cache()
+        return n_updated
 
     @property
     def corpus(self):
@@ -39,81 +117,148 @@ class SearchEngine:
 
     @corpus.setter
     def corpus(self, idx_type):
+        if idx_type == 'hybrid':
+            # гибридный индекс ищет движками, которые сами загружают свои корпуса
+            self.corpus_ = pd.DataFrame({'id': [], 'text': []})
+            self.corpus_fingerprint = None  # вычисляется по движкам в init_model
+            return
         if idx_type == 'bert':
             self.corpus_ = pd.DataFrame(self.db.get_raw_texts(), columns=['id', 'text'])
         else:
             self.corpus_ = pd.DataFrame(self.db.get_lemmatized_texts(), columns=['id', 'lemmatized'])
+            self.corpus_ = self.corpus_.dropna().reset_index(drop=True)  # еще не лемматизированные тексты
+        self.corpus_fingerprint = BaseSearch.fingerprint(self.corpus_)
 
     def init_model(self, idx_type, implementation):
         if idx_type == 'bm25':
             if implementation == 'BM25Matrices':
-                return BM25Matrices(
+                return indexing.BM25Matrices(
                     corpus=self.corpus,
                     k=float(self.defaults['k']),
-                    b=float(self.defaults['b'])
+                    b=float(self.defaults['b']),
+                    index_folder=self.index_folder
                 )
             elif implementation == 'BM25Dict':
-                return BM25Dict(
+                return indexing.BM25Dict(
                     corpus=self.corpus,
                     k=float(self.defaults['k']),
                     b=float(self.defaults['b']))
             elif implementation == 'BM25Search':
-                return BM25Search(
+                return indexing.BM25Search(
                     corpus=self.corpus
                 )
+            elif implementation == 'BM25Inverted':
+                return indexing.BM25Inverted(
+                    corpus=self.corpus,
+                    k=float(self.defaults['k']),
+                    b=float(self.defaults['b']),
+                    index_folder=self.index_folder
+                )
             else:
                 raise ValueError('Unknown implementation')
         elif idx_type == 'freq':
             if implementation == 'FreqMatrix':
-                return FreqMatrix(
-                    corpus=self.corpus
+                return indexing.FreqMatrix(
+                    corpus=self.corpus,
+                    index_folder=self.index_folder
                 )
             elif implementation == 'CountVectSearch':
-                return CountVectSearch(
+                return indexing.CountVectSearch(
                     corpus=self.corpus
                 )
             elif implementation == 'FreqDict':
-                return FreqDict(
+                return indexing.FreqDict(
                     corpus=self.corpus
                 )
+            elif implementation == 'FreqInverted':
+                return indexing.FreqInverted(
+                    corpus=self.corpus,
+                    index_folder=self.index_folder
+                )
+            else:
+                raise ValueError('Unknown implementation')
         elif idx_type == 'w2v':
             if implementation == 'Word2VecSearch':
-                return Word2VecSearch(
+                return indexing.Word2VecSearch(
                     corpus=self.corpus,
                     model_name_=self.defaults['model_name'],
                     nlp_=self.nlp,
                     model_path=self.defaults['model_path'],
                     index_folder_=self.index_folder,
-                    similarity_metric=self.defaults['similarity_metric']
+                    similarity_metric=self.defaults['similarity_metric'],
+                    restrict_vocab=parse_bool(self.defaults.get('restrict_vocab', False)),
+                    restrict_vocab_top_n=int(self.defaults.get('restrict_vocab_top_n', 100000))
                 )
             else:
                 raise ValueError('Unknown implememtation')
         elif idx_type == 'ft':
             if implementation == 'FastTextSearch':
-                return FastTextSearch(
+                return indexing.FastTextSearch(
                     corpus=self.corpus,
                     model_name_=self.defaults['model_name'],
                     model_path=self.defaults['model_path'],
                     index_folder_=self.index_folder,
-                    similarity_metric=self.defaults['similarity_metric']
+                    similarity_metric=self.defaults['similarity_metric'],
+                    serving=self.defaults.get('serving', 'full'),
+                    lite_vocab_top_n=int(self.defaults.get('lite_vocab_top_n', 200000)),
+                    lite_dtype=self.defaults.get('lite_dtype', 'float16')
                 )
             else:
                 raise ValueError('Unknown implementation')
         elif idx_type == 'bert':
             if implementation == 'BertIndex':
-                return BertIndex(
+                return indexing.BertIndex(
                     corpus=self.corpus,
                     nlp_=self.nlp,
                     model_name=self.defaults['model_name'],
                     model_path=self.defaults['model_path'],
                     index_folder_=self.index_folder,
-                    similarity_metric=self.defaults['similarity_metric']
+                    similarity_metric=self.defaults['similarity_metric'],
+                    batch_size=int(self.defaults.get('batch_size', 32))
+                )
+            else:
+                raise ValueError('Unknown implementation')
+        elif idx_type == 'hybrid':
+            if implementation == 'HybridSearch':
+                self.sub_engines = [self.init_sub_engine(sub_type) for sub_type in self.defaults['engines']]
+                self.corpus_fingerprint = self.hybrid_fingerprint()
+                return indexing.HybridSearch(
+                    corpus=self.corpus,
+                    engines=[(engine.model, engine.preprocessor) for engine in self.sub_engines],
+                    weights=[float(w) for w in self.defaults.get('weights') or []] or None,
+                    fusion=self.defaults.get('fusion', 'rrf'),
+                    rrf_k=float(self.defaults.get('rrf_k', 60)),
+                    n_candidates=int(self.defaults.get('n_candidates', 100))
                 )
             else:
                 raise ValueError('Unknown implementation')
         else:
             raise ValueError('Unknown index type')
 
+    def init_sub_engine(self, idx_type: str) -> 'SearchEngine':
+        """
+        Creates search engine of another index type with its default settings (used by hybrid index)
+        """
+        return SearchEngine(
+            index_type=idx_type,
+            implementation=MODEL_DEFAULTS[idx_type]['implementation'],
+            index_folder=self.index_folder,
+            data_retriever=self.db,
+            defaults=MODEL_DEFAULTS[idx_type],
+            preprocessor=MODEL_DEFAULTS[idx_type]['preprocessor_'],
+            sync_on_load=self.sync_on_load
+        )
+
+    def hybrid_fingerprint(self) -> str:
+        """
+        Fingerprint of the hybrid index: combination of fingerprints of its engines' corpora
+        """
+        return hashlib.sha1(' '.join(engine.corpus_fingerprint for engine in self.sub_engines).encode()).hexdigest()
+
+    @property
+    def nlp(self) -> 'Language':
+        return load_nlp()
+
     @property
     def preprocessor(self):
         return self.preprocessor_
@@ -122,16 +267,20 @@ class SearchEngine:
     def preprocessor(self, name: Union[str, Callable[[str], str]]):
         if isinstance(name, str):
             if name == 'lemmatize':
-                self.preprocessor_ = partial(self.spacy_preprocessing, nlp=self.nlp)
+                # пайплайн spacy загружается при первом запросе, а не при создании движка
+                self.preprocessor_ = lambda text: self.spacy_preprocessing(text, self.nlp)
+                self.batch_preprocessor_ = lambda texts: self.spacy_preprocessing_batch(texts, self.nlp)
             elif name == 'raw':
                 self.preprocessor_ = lambda x: x
+                self.batch_preprocessor_ = list
             else:
                 raise ValueError('Wrong preprocessor name')
         else:
             self.preprocessor_ = name
+            self.batch_preprocessor_ = lambda texts: [name(text) for text in texts]
 
     @staticmethod
-    def spacy_preprocessing(text: str, nlp: Language) -> str:
+    def spacy_preprocessing(text: str, nlp: 'Language') -> str:
         """
         Delete punctuation, stop-words and numbers and then lemmatize
         Args:
@@ -140,12 +289,20 @@ class SearchEngine:
 
         Returns: lemmatized text
         """
-        lemmatized = []
         text = re.sub(r'\s+', ' ', text)
-        for token in nlp(text):
-            if not token.is_punct and not token.is_stop and not token.is_digit:
-                lemmatized.append(token.lemma_.lower())
-        return ' '.join(lemmatized)
+        return lemmatize_doc(nlp(text))
+
+    @staticmethod
+    def spacy_preprocessing_batch(texts: List[str], nlp: 'Language') -> List[str]:
+        """
+        Same as spacy_preprocessing, but processes many texts with nlp.pipe
+        Args:
+            texts: list of texts
+            nlp: spacy nlp object
+
+        Returns: list of lemmatized texts
+        """
+        return [lemmatized for _, lemmatized in lemmatize_texts(enumerate(texts), nlp)]
 
     @classmethod
     def download_model(cls,
@@ -156,16 +313,96 @@ class SearchEngine:
             model_path = Path(model_path)
             model_path.parent.mkdir(parents=True, exist_ok=True)
             if not model_path.exists():
-                cls.downloadable[idx_type].download_model(url, model_path)
+                getattr(indexing, cls.downloadable[idx_type]).download_model(url, model_path)
         else:
             raise ValueError('Wrong index type')
 
-    def search(self, query, n):
-        lemmatized_query = self.preprocessor(query)
-        if not lemmatized_query:
-            raise QueryError('Query has no content words. Please change your query to something more meaningful :(')
-        found_documents = self.model.rank_documents(lemmatized_query, n)
-        results = [self.db.get_thesis_info(i) for i in found_documents]
+    def invalidate_cache(self):
+        """
+        Removes cached results of this index type (called when the index or the corpus changes)
+        """
+        self.result_cache.invalidate(lambda key: key[0] == self.index_type)
+
+    def cache_key(self, query: str, n: int, filters: Dict[str, List[Any]] = None) -> tuple:
+        normalized_query = ' '.join(query.split())
+        normalized_filters = tuple(sorted((field, tuple(values)) for field, values in (filters or {}).items()))
+        return self.index_type, self.implementation, self.corpus_fingerprint, normalized_query, n, normalized_filters
+
+    @staticmethod
+    def normalize_filters(filters: Dict[str, Any] = None) -> Dict[str, List[Any]]:
+        """
+        Drops empty filters, turns single values into lists and years into numbers
+        (values can come from the web form or command line as strings)
+        """
+        normalized = {}
+        for field, values in (filters or {}).items():
+            if values is None or values == '':
+                continue
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            values = [v for v in values if v is not None and v != '']
+            if field == 'year':
+                values = [int(v) for v in values]
+            if values:
+                normalized[field] = sorted(set(values))
+        return normalized
+
+    def search(self, query, n, filters: Dict[str, Any] = None, timings: Dict[str, float] = None):
+        """
+        Finds n documents relevant to the query
+        Args:
+            query: search query
+            n: number of documents in the result
+            filters: {'year': ..., 'program': ..., 'supervisor': ...} - value or list of values of each field,
+                only documents that satisfy all filters are searched
+            timings: if given, is filled with durations of search stages in seconds
+                (stays empty if the result was taken from the cache)
+
+        Returns: list of (title, year, program, student, supervisors, text, file links)
+        """
+        filters = self.normalize_filters(filters)
+        key = self.cache_key(query, n, filters)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            self.metrics.record_cache_hit(self.index_type)
+            return list(cached)
+
+        start = time.perf_counter()
+        with trace() as stages:
+            with stage('preprocess'):
+                lemmatized_query = self.preprocessor(query)
+            if not lemmatized_query:
+                raise QueryError('Query has no content words. Please change your query to something more meaningful :(')
+            found_documents = self.model.rank_documents(lemmatized_query, n, filters or None)
+            with stage('db_fetch'):
+                results = self.db.get_theses_info(found_documents)
+        stages['total'] = time.perf_counter() - start
+        self.metrics.record(self.index_type, stages)
+        if timings is not None:
+            timings.update(stages)
+        self.result_cache.put(key, tuple(results))
+        return results
+
+    def search_many(self, queries: List[str], n: int) -> List[list]:
+        """
+        Searches many queries at once: queries are preprocessed with nlp.pipe, scored together
+        by the model and metadata of all found documents is fetched in bulk. Cache is not used
+        Args:
+            queries: list of queries
+            n: number of documents in the result for each query
+
+        Returns: list of results (one per query), queries without content words get empty result
+        """
+        lemmatized_queries = self.batch_preprocessor_(queries)
+        non_empty = [i for i, query in enumerate(lemmatized_queries) if query]
+        ranked = self.model.rank_documents_batch([lemmatized_queries[i] for i in non_empty], n)
+
+        found_documents = {doc for docs in ranked for doc in docs}
+        info = self.db.get_theses_info_map(found_documents)
+
+        results = [[] for _ in queries]
+        for i, docs in zip(non_empty, ranked):
+            results[i] = [info[doc] for doc in docs if doc in info]
         return results
 
 
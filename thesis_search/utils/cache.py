@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with limited size and time to live of the entries
+    Attributes:
+        maxsize: maximum number of stored entries (0 disables caching)
+        ttl: time to live of the entry in seconds (None - entries never expire)
+        hits: number of successful lookups
+        misses: number of lookups that found nothing
+    """
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 3600):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl) if ttl is not None else None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # {key: (expiration time, value)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns cached value and marks it as recently used
+        Args:
+            key: cache key
+
+        Returns: cached value or None if there is no such key or it has expired
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Saves value to the cache, evicting least recently used entries if cache is full
+        Args:
+            key: cache key
+            value: value to store
+        """
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, condition: Callable[[Hashable], bool] = None):
+        """
+        Removes entries from the cache
+        Args:
+            condition: function that takes the key and returns True if the entry should be removed,
+                if None the whole cache is cleared
+        """
+        with self._lock:
+            if condition is None:
+                self._data.clear()
+            else:
+                for key in [k for k in self._data if condition(k)]:
+                    del self._data[key]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns: cache counters {hits, misses, size}
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
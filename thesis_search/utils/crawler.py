@@ -1,17 +1,80 @@
+import json
+import os
+import threading
 import requests
 import time
-from typing import Iterable, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterable, Iterator, Tuple, Union, Dict, Any
 
 from bs4 import BeautifulSoup
 from .models import Thesis
 
 
+class RateLimiter:
+    """
+    Позволяет делать не больше rate запросов в секунду (общий для всех потоков, запросы распределяются равномерно)
+    """
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+class CrawlCheckpoint:
+    """
+    Прогресс скрэппинга, сохраненный в json-файл: для каждого unit номер последней полностью обработанной
+    страницы и id уже обработанных вкр следующей страницы. Если autosave=False, прогресс записывается в файл
+    только при вызове save (например, после того как вкр записаны в базу)
+    """
+    def __init__(self, path: Union[str, os.PathLike] = None, autosave: bool = True):
+        self.path = Path(path) if path else None
+        self.autosave = autosave
+        self.state: Dict[str, Dict[str, Any]] = {}
+        if self.path and self.path.exists():
+            self.state = json.loads(self.path.read_text())
+
+    def last_page(self, unit: str) -> int:
+        return self.state.get(unit, {}).get('page', 0)
+
+    def done_theses(self, unit: str) -> set:
+        return set(self.state.get(unit, {}).get('theses', []))
+
+    def complete_thesis(self, unit: str, thesis_id: int):
+        self.state.setdefault(unit, {'page': 0, 'theses': []})['theses'].append(thesis_id)
+        if self.autosave:
+            self.save()
+
+    def complete_page(self, unit: str, page: int):
+        self.state[unit] = {'page': page, 'theses': []}
+        if self.autosave:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.state))
+        os.replace(tmp_path, self.path)
+
+
 class HSEVKRScrapper:
     """
     Класс для скрэппинга страниц с темами вкр
     """
 
     request_url = 'https://www.hse.ru/n/vkr/api/'
+    retry_statuses = {429, 500, 502, 503, 504}
     default_headers = {
         'authority': 'www.hse.ru',
         'accept': 'application/json, text/plain, */*',
@@ -27,9 +90,29 @@ class HSEVKRScrapper:
         'x-portal-language': 'ru',
     }
 
-    def __init__(self, headers=None):
-        self.__session = requests.session()
+    def __init__(self,
+                 headers=None,
+                 request_url: str = None,
+                 requests_per_second: float = None,
+                 max_retries: int = 3,
+                 backoff: float = 1,
+                 timeout: float = 30):
+        """
+        Args:
+            headers: заголовки запросов (по умолчанию default_headers)
+            request_url: адрес api (можно подменить на локальный для тестов)
+            requests_per_second: ограничение на число запросов в секунду для всех потоков (None - без ограничения)
+            max_retries: сколько раз повторять запрос при ошибке соединения или ответе 429/5xx
+            backoff: пауза перед первым повтором в секундах, дальше она удваивается
+            timeout: таймаут одного запроса в секундах
+        """
+        self._local = threading.local()  # у каждого потока своя сессия
         self.headers = headers
+        self.request_url = request_url or HSEVKRScrapper.request_url
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
 
     @property
     def headers(self):
@@ -42,30 +125,54 @@ class HSEVKRScrapper:
         else:
             self.__headers = headers
 
+    @property
+    def session(self) -> requests.Session:
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.session()
+        return self._local.session
+
+    def _get(self, url: str, params: dict = None, headers: dict = None) -> requests.Response:
+        """
+        GET-запрос с ограничением частоты и повторами с экспоненциальной паузой
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                if response.status_code not in HSEVKRScrapper.retry_statuses:
+                    response.raise_for_status()
+                    return response
+                error = requests.HTTPError(f'{response.status_code} for url: {response.url}', response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt == self.max_retries:
+                raise error
+            time.sleep(self.backoff * 2 ** attempt)
+
     def _get_data_unit(self, vkr_page: str) -> str:
-        page = self.__session.get(vkr_page).text
+        page = self._get(vkr_page).text
         soup = BeautifulSoup(page, features="lxml")
         unit = soup.find("body", recursive=True).get('data-unit')
         return unit
 
     def parse_thesis_page(self, thesis_id: int) -> Tuple[str, str]:
-        url = HSEVKRScrapper.request_url + str(thesis_id)
-        response = self.__session.get(url, headers=self.headers).json()
+        url = self.request_url + str(thesis_id)
+        response = self._get(url, headers=self.headers).json()
         if response['file']:
             response['file'] = response['file']['url']
         return response['file'], response['abstract']
 
-    def get_page_theses(self, unit: str, page: str, sleep: float = 1) -> Iterable[Thesis]:
+    def _get_page_list(self, unit: str, page: str) -> Iterable[Thesis]:
         params = {
             'unit': unit,
             'page': page,
         }
-        response = self.__session.get(HSEVKRScrapper.request_url, params=params, headers=self.headers)
-        page_theses = response.json()['data']
+        response = self._get(self.request_url, params=params, headers=self.headers)
+        return [self._create_thesis_info(thesis_dict) for thesis_dict in response.json()['data']]
 
+    def get_page_theses(self, unit: str, page: str, sleep: float = 1) -> Iterable[Thesis]:
         theses = []
-        for thesis_dict in page_theses:
-            thesis = self._create_thesis_info(thesis_dict)
+        for thesis in self._get_page_list(unit, page):
             time.sleep(sleep)
             thesis.file, thesis.abstract = self.parse_thesis_page(thesis.thesis_id)
             theses.append(thesis)
@@ -82,7 +189,7 @@ class HSEVKRScrapper:
         return thesis
 
     def _get_total_pages(self, unit: str) -> int:
-        response = self.__session.get(HSEVKRScrapper.request_url, params={'unit': unit}, headers=self.headers)
+        response = self._get(self.request_url, params={'unit': unit}, headers=self.headers)
         return response.json()['totalPages']
 
     def crawl(self, vkr_page, pagelimit: int = 30, sleep: float = 0):
@@ -92,3 +199,38 @@ class HSEVKRScrapper:
         for page in range(1, pagelimit + 1):
             theses.extend(self.get_page_theses(data_unit, str(page), sleep))
         return theses
+
+    def iter_crawl(self,
+                   vkr_page: str,
+                   pagelimit: int = 30,
+                   workers: int = 8,
+                   checkpoint: CrawlCheckpoint = None) -> Iterator[Thesis]:
+        """
+        Скачивает страницы вкр в несколько потоков и отдает вкр по мере получения. Вкр отмечается в чекпоинте
+        после того, как потребитель ее обработал (когда запрашивает следующую), поэтому прерванный скрэппинг
+        продолжается с того же места
+        Args:
+            vkr_page: страница с вкр образовательной программы
+            pagelimit: максимальное число страниц
+            workers: число потоков
+            checkpoint: прогресс предыдущего запуска (None - начать сначала и не сохранять прогресс)
+
+        Returns: генератор вкр (порядок внутри страницы не сохраняется)
+        """
+        checkpoint = checkpoint or CrawlCheckpoint()
+        data_unit = self._get_data_unit(vkr_page)
+        pagelimit = min(self._get_total_pages(data_unit), pagelimit)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for page in range(checkpoint.last_page(data_unit) + 1, pagelimit + 1):
+                done = checkpoint.done_theses(data_unit)
+                theses = [t for t in self._get_page_list(data_unit, str(page)) if t.thesis_id not in done]
+                futures = {executor.submit(self.parse_thesis_page, t.thesis_id): t for t in theses}
+                for future in as_completed(futures):
+                    thesis = futures[future]
+                    thesis.file, thesis.abstract = future.result()
+                    yield thesis
+                    checkpoint.complete_thesis(data_unit, thesis.thesis_id)
+                checkpoint.complete_page(data_unit, page)
+        finally:
+            executor.shutdown(cancel_futures=True)  # при ошибке или остановке не ждать оставшиеся запросы
@@ -1,20 +1,112 @@
+import queue
 import sqlite3
 import os
-from typing import Iterable, Union, Tuple
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, Union, Tuple, List, Dict, Any
 from dataclasses import asdict
 
 from .models import Thesis
 
 
 class DBHandler:
+    """
+    Writes go through one shared connection, reads go through the pool of read-only connections (see read)
+    """
 
     def __init__(self, db_path: Union[os.PathLike, str]):
+        self.db_path = db_path
         self.conn = sqlite3.connect(db_path, check_same_thread=False)
         self.cur = self.conn.cursor()
+        self.set_pragmas()
+
+        self._read_pool = queue.SimpleQueue()
+        self._read_conns = []
+
+    def open_read_connection(self) -> sqlite3.Connection:
+        """
+        Opens a read-only connection (mode=ro). In WAL mode it needs the -wal and -shm files next to the database
+        and can't create them, so it fails if no writer has opened the database since it was closed and the
+        folder is not writable. Then a normal connection with query_only is opened instead: it creates these files
+        itself when the folder is writable and still can't modify the database
+        """
+        if str(self.db_path) == ':memory:':  # у базы в памяти нет файла, который можно открыть еще раз
+            return self.conn
+        uri = Path(self.db_path).resolve().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+        try:
+            conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchall()  # файлы WAL открываются при первом чтении
+        except sqlite3.OperationalError:
+            conn.close()
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+            conn.execute('PRAGMA query_only = 1')
+        conn.executescript('''
+            PRAGMA temp_store = MEMORY;
+            PRAGMA cache_size = -65536;
+            ''')
+        self._read_conns.append(conn)
+        return conn
+
+    def read(self, query: str, params: Iterable = ()) -> List[tuple]:
+        """
+        Executes read query on a read-only connection taken from the pool. Connection is used by
+        one thread at a time (new one is opened if all are busy), so concurrent requests of the web server
+        don't share cursors, and every connection keeps its own cache of prepared statements
+        Args:
+            query: sql query
+            params: query parameters
+
+        Returns: all fetched rows
+        """
+        try:
+            conn = self._read_pool.get_nowait()
+        except queue.Empty:
+            conn = self.open_read_connection()
+        try:
+            return conn.execute(query, params).fetchall()
+        finally:
+            self._read_pool.put(conn)
+
+    def set_pragmas(self):
+        """
+        Settings of this connection only (they don't change the database file)
+        """
+        self.cur.executescript('''
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA cache_size = -65536;
+            ''')
+
+    def enable_wal(self):
+        """
+        Switches the database to WAL, so readers work while theses are being written, and with synchronous=NORMAL
+        a transaction needs no fsync on commit (only on checkpoints). The mode is stored in the database file,
+        so it is set from the write path and read-only users never modify the file
+        """
+        if self.conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            self.conn.execute('PRAGMA journal_mode = WAL')
 
     def __del__(self):
+        for conn in getattr(self, '_read_conns', []):
+            if conn is not self.conn:
+                conn.close()
         self.conn.close()
 
+    def create_indices(self):
+        """
+        Creates indices on foreign keys used to collect thesis metadata (tables that don't exist yet are skipped).
+        Is called from the write paths, so opening the database for reading never modifies it
+        """
+        tables = {row[0] for row in self.conn.execute('''
+            SELECT name
+            FROM sqlite_master
+            WHERE type = 'table' ''')}
+        for table in ('supervising_info', 'files'):
+            if table in tables:
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_thesis_id_idx ON {table} (thesis_id)')
+        self.conn.commit()
+
     def add_supervisors(self, supervisors: Iterable[str]):
         supervisors = [(sup, ) for sup in supervisors]
         self.cur.executemany('''
@@ -63,18 +155,108 @@ class DBHandler:
         self.conn.commit()
 
     def add_thesis_info(self, text_info: Thesis):
-        self.add_program(text_info.learn_program)
-        self.add_supervising_info(text_info.thesis_id, text_info.supervisors)
-        self.add_thesis(text_info)
-        if text_info.file:
-            self.add_file(text_info.thesis_id, text_info.file)
-        self.conn.commit()
+        self.add_theses([text_info])
+
+    def add_theses(self, theses: Iterable[Thesis], chunk_size: int = 500) -> Tuple[int, float]:
+        """
+        Adds theses with their programs, supervisors and files, one transaction per chunk of theses
+        (theses that are already in the database are skipped)
+        Args:
+            theses: theses to add
+            chunk_size: number of theses in one transaction
+
+        Returns: number of added theses and speed in theses per second
+        """
+        self.enable_wal()
+        self.create_indices()
+        start = time.perf_counter()
+        total = 0
+        theses = iter(theses)
+        while chunk := list(islice(theses, chunk_size)):
+            ids = [thesis.thesis_id for thesis in chunk]
+            known = {row[0] for row in self.conn.execute(f'''
+                SELECT id
+                FROM theses
+                WHERE id IN ({', '.join('?' * len(ids))})''', ids)}
+            new = []
+            for thesis in chunk:
+                if thesis.thesis_id not in known:
+                    known.add(thesis.thesis_id)
+                    new.append(thesis)
+            if new:
+                self._insert_theses(new)
+                total += len(new)
+        elapsed = time.perf_counter() - start
+        return total, total / elapsed if elapsed else 0.
+
+    def _insert_theses(self, theses: List[Thesis]):
+        with self.conn:  # одна транзакция: commit в конце или rollback при ошибке
+            self.conn.executemany('''
+                INSERT or IGNORE
+                INTO programs (name)
+                VALUES (?)''', {(thesis.learn_program, ) for thesis in theses})
+            self.conn.executemany('''
+                INSERT or IGNORE
+                INTO supervisors (name)
+                VALUES (?)''', {(sup, ) for thesis in theses for sup in thesis.supervisors or []})
+            self.conn.executemany('''
+                INSERT INTO theses (id, title, text, student, program_id, year)
+                VALUES (
+                :thesis_id,
+                :title,
+                :abstract,
+                :student,
+                (SELECT id FROM programs WHERE programs.name = :learn_program),
+                :year
+                )''', (asdict(thesis) for thesis in theses))
+            self.conn.executemany('''
+                INSERT INTO supervising_info (thesis_id, supervisor_id)
+                VALUES (
+                ?,
+                (SELECT id FROM supervisors WHERE name = ?)
+                )''', ((thesis.thesis_id, sup) for thesis in theses for sup in thesis.supervisors or []))
+            self.conn.executemany('''
+                INSERT INTO files (thesis_id, link)
+                VALUES (?, ?)''', ((thesis.thesis_id, thesis.file) for thesis in theses if thesis.file))
+
+    def get_theses_ids(self) -> set:
+        rows = self.read('''
+            SELECT id
+            FROM theses''')
+        return {row[0] for row in rows}
 
     def get_raw_texts(self) -> Iterable[Tuple[int, str]]:
-        self.cur.execute('''
+        return self.read('''
             SELECT id,  text
             FROM theses''')
-        return self.cur.fetchall()
+
+    def iter_raw_texts(self, chunk_size: int = 1000) -> Iterator[Tuple[int, str]]:
+        """
+        Streams texts from the database, reading chunk_size rows at a time
+        Args:
+            chunk_size: number of rows fetched by one query
+
+        Returns: generator of (thesis id, text) pairs ordered by id
+        """
+        last_id = None
+        while True:
+            if last_id is None:
+                rows = self.read('''
+                    SELECT id, text
+                    FROM theses
+                    ORDER BY id
+                    LIMIT (?)''', (chunk_size, ))
+            else:
+                rows = self.read('''
+                    SELECT id, text
+                    FROM theses
+                    WHERE id > (?)
+                    ORDER BY id
+                    LIMIT (?)''', (last_id, chunk_size))
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1][0]
 
     def add_lemmatization(self, theses_id: Iterable[int], lemmatized: Iterable[str]):
         self.cur.executemany('''
@@ -84,22 +266,78 @@ class DBHandler:
         self.conn.commit()
 
     def get_thesis_info(self, thesis_id: int) -> Tuple[str, int, str, str, str, str, str]:
-        self.cur.execute('''
-            SELECT theses.title, theses.year, programs.name, theses.student, supervisors.name, theses.text, files.link
-            FROM theses
-            LEFT JOIN programs
-            ON programs.id = theses.program_id
-            LEFT JOIN files
-            ON files.thesis_id = theses.id
-            LEFT JOIN supervising_info
-            ON supervising_info.thesis_id = theses.id
-            LEFT JOIN supervisors
-            ON supervisors.id = supervising_info.supervisor_id
-            WHERE theses.id = (?)''', (thesis_id, ))
-        return self.cur.fetchone()
+        info = self.get_theses_info([thesis_id])
+        return info[0] if info else None
+
+    def get_theses_info(self,
+                        theses_id: Iterable[int],
+                        chunk_size: int = 500) -> List[Tuple[str, int, str, str, str, str, str]]:
+        """
+        Fetches metadata of many theses with one query per chunk of ids
+        Args:
+            theses_id: ids of theses in the order they should be returned
+            chunk_size: maximum number of ids in one query (sqlite limits the number of parameters)
+
+        Returns: list of (title, year, program, student, supervisors, text, file links) in the order of theses_id,
+            several supervisors are joined with ', ' and several file links with ' ', unknown ids are skipped
+        """
+        theses_id = list(theses_id)
+        found = self.get_theses_info_map(theses_id, chunk_size)
+        return [found[i] for i in theses_id if i in found]
+
+    def get_theses_info_map(self,
+                            theses_id: Iterable[int],
+                            chunk_size: int = 500) -> Dict[int, Tuple[str, int, str, str, str, str, str]]:
+        """
+        Same as get_theses_info, but returns mapping {thesis id: metadata}
+        """
+        theses_id = list(theses_id)
+        found = {}
+        for start in range(0, len(theses_id), chunk_size):
+            chunk = theses_id[start:start + chunk_size]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = self.read(f'''
+                SELECT theses.id, theses.title, theses.year, programs.name, theses.student,
+                    (SELECT GROUP_CONCAT(supervisors.name, ', ')
+                     FROM supervising_info
+                     JOIN supervisors
+                     ON supervisors.id = supervising_info.supervisor_id
+                     WHERE supervising_info.thesis_id = theses.id),
+                    theses.text,
+                    (SELECT GROUP_CONCAT(files.link, ' ')
+                     FROM files
+                     WHERE files.thesis_id = theses.id)
+                FROM theses
+                LEFT JOIN programs
+                ON programs.id = theses.program_id
+                WHERE theses.id IN ({placeholders})''', chunk)
+            found.update({row[0]: row[1:] for row in rows})
+        return found
+
+    def get_metadata(self) -> Dict[str, List[Tuple[int, Any]]]:
+        """
+        Collects values of fields that can be used as search filters
+        Returns: {'year': [(thesis id, year)], 'program': [(thesis id, program)],
+            'supervisor': [(thesis id, supervisor)]} (thesis can have several supervisors)
+        """
+        return {
+            'year': self.read('''
+                SELECT id, year
+                FROM theses
+                WHERE year IS NOT NULL'''),
+            'program': self.read('''
+                SELECT theses.id, programs.name
+                FROM theses
+                JOIN programs
+                ON programs.id = theses.program_id'''),
+            'supervisor': self.read('''
+                SELECT supervising_info.thesis_id, supervisors.name
+                FROM supervising_info
+                JOIN supervisors
+                ON supervisors.id = supervising_info.supervisor_id''')
+        }
 
     def get_lemmatized_texts(self):
-        self.cur.execute('''
+        return self.read('''
             SELECT id, lemmatized
             FROM theses''')
-        return self.cur.fetchall()
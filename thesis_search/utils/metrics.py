@@ -0,0 +1,148 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional, Tuple, List
+
+STAGES = ('preprocess', 'vectorize', 'tokenize', 'forward', 'score', 'top_k', 'db_fetch', 'total')
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('search_stage_timings', default=None)
+_timings_lock = threading.Lock()  # движки гибридного индекса пишут в один словарь из разных потоков
+
+
+@contextmanager
+def trace() -> Iterator[Dict[str, float]]:
+    """
+    Collects durations of stages (see stage) that run inside the block, including engines of the hybrid index
+    that run in other threads with the copied context
+    Returns: {stage: seconds}, filled when the block exits
+    """
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Adds the duration of the block to the stage of the current trace (does nothing outside of trace).
+    tokenize and forward are parts of vectorize
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _timings_lock:
+            timings[name] = timings.get(name, 0.) + elapsed
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values in the Prometheus format
+    Attributes:
+        buckets: upper bounds of buckets (+Inf bucket is implicit)
+        counts: number of observations in each bucket (not cumulative), the last one is +Inf
+        sum: sum of observed values
+        count: number of observations
+    """
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        Returns: [(upper bound, number of observations <= bound)] including +Inf
+        """
+        with self._lock:
+            counts = list(self.counts)
+        result, total = [], 0
+        for bound, count in zip([f'{b:g}' for b in self.buckets] + ['+Inf'], counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class SearchMetrics:
+    """
+    Histograms of search stage durations for every index type, rendered in the Prometheus text format
+    Attributes:
+        histograms: {(index type, stage): Histogram}
+        cache_hits: {index type: number of queries answered from the result cache}
+    """
+    name = 'thesis_search_stage_seconds'
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.cache_hits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, index_type: str, stage_name: str) -> Histogram:
+        key = (index_type, stage_name)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            return self.histograms[key]
+
+    def record(self, index_type: str, timings: Dict[str, float]):
+        """
+        Adds durations of one query
+        Args:
+            index_type: index type that served the query
+            timings: {stage: seconds}
+        """
+        for stage_name, seconds in timings.items():
+            self.histogram(index_type, stage_name).observe(seconds)
+
+    def record_cache_hit(self, index_type: str):
+        with self._lock:
+            self.cache_hits[index_type] = self.cache_hits.get(index_type, 0) + 1
+
+    def render(self) -> str:
+        """
+        Returns: all metrics in the Prometheus text exposition format
+        """
+        lines = [f'# HELP {self.name} Duration of search stages (tokenize and forward are parts of vectorize)',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            cache_hits = sorted(self.cache_hits.items())
+        for (index_type, stage_name), histogram in histograms:
+            labels = f'index_type="{index_type}",stage="{stage_name}"'
+            for bound, count in histogram.cumulative():
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{self.name}_count{{{labels}}} {histogram.count}')
+        lines += ['# HELP thesis_search_cache_hits_total Queries answered from the result cache',
+                  '# TYPE thesis_search_cache_hits_total counter']
+        lines += [f'thesis_search_cache_hits_total{{index_type="{index_type}"}} {hits}'
+                  for index_type, hits in cache_hits]
+        return '\n'.join(lines) + '\n'
+
+
+def format_timings(timings: Dict[str, float]) -> List[Tuple[str, str]]:
+    """
+    Orders stages as they run and formats durations in milliseconds
+    Returns: [(stage, 'x.xx ms')]
+    """
+    order = {name: i for i, name in enumerate(STAGES)}
+    return [(name, f'{timings[name] * 1000:.2f} ms') for name in sorted(timings, key=lambda n: order.get(n, len(order)))]
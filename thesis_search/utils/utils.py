@@ -1,10 +1,43 @@
 import re
-from typing import Iterable
+import threading
+from typing import Iterable, Iterator, Tuple, TYPE_CHECKING
 
-from spacy import Language
+from tqdm import tqdm
 
+from .database import DBHandler
 from .models import Thesis
 
+if TYPE_CHECKING:
+    from spacy import Language
+    from spacy.tokens import Doc
+    from .crawler import HSEVKRScrapper
+
+# компоненты пайплайна, которые не нужны для лемматизации
+LEMMATIZATION_DISABLED = ['parser', 'senter', 'ner']
+SPACY_MODEL = 'ru_core_news_sm'
+
+_nlp = None
+_nlp_lock = threading.Lock()
+
+
+def load_nlp() -> 'Language':
+    """
+    Loads spacy pipeline on the first call (spacy is imported only here), then returns the same object
+    """
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            import spacy
+            _nlp = spacy.load(SPACY_MODEL, exclude=['ner'])
+    return _nlp
+
+
+def parse_bool(value) -> bool:
+    """
+    Converts a config value to bool: values from config files are strings, so 'false' or '0' must be False
+    """
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
 
 def filter_texts(results: Iterable[Thesis], threshold: int = 100) -> Iterable[Thesis]:
     """
@@ -21,7 +54,7 @@ def filter_texts(results: Iterable[Thesis], threshold: int = 100) -> Iterable[Th
     return clean_theses
 
 
-def preprocessing(text: str, nlp: Language) -> str:
+def preprocessing(text: str, nlp: 'Language') -> str:
     """
     Удаляет пунктуацию, стоп-слова и числа, оставшееся лемматизирует
     Args:
@@ -30,14 +63,133 @@ def preprocessing(text: str, nlp: Language) -> str:
 
     Returns: лемматизированный текст
     """
-    lemmatized = []
     text = re.sub(r'\s+', ' ', text)
-    for token in nlp(text):
+    return lemmatize_doc(nlp(text))
+
+
+def lemmatize_doc(doc: 'Doc') -> str:
+    """
+    Удаляет пунктуацию, стоп-слова и числа из обработанного спейси текста, оставшееся лемматизирует
+    Args:
+        doc: spacy doc
+
+    Returns: лемматизированный текст
+    """
+    lemmatized = []
+    for token in doc:
         if not token.is_punct and not token.is_stop and not token.is_digit:
             lemmatized.append(token.lemma_.lower())
     return ' '.join(lemmatized)
 
 
+def lemmatize_texts(texts: Iterable[Tuple[int, str]],
+                    nlp: 'Language',
+                    batch_size: int = 64,
+                    n_process: int = 1) -> Iterator[Tuple[int, str]]:
+    """
+    Лемматизирует поток текстов через nlp.pipe (в n_process процессов), отключая ненужные компоненты пайплайна
+    Args:
+        texts: пары (id текста, текст)
+        nlp: spacy nlp object
+        batch_size: количество текстов в одном батче спейси
+        n_process: количество процессов (-1 - все ядра)
+
+    Returns: генератор пар (id текста, лемматизированный текст)
+    """
+    disabled = [name for name in LEMMATIZATION_DISABLED if name in nlp.pipe_names]
+    texts = ((re.sub(r'\s+', ' ', text or ''), text_id) for text_id, text in texts)
+    for doc, text_id in nlp.pipe(texts, as_tuples=True, batch_size=batch_size, n_process=n_process,
+                                 disable=disabled):
+        yield text_id, lemmatize_doc(doc)
+
+
+def lemmatize_corpus(db: DBHandler,
+                     nlp: 'Language',
+                     batch_size: int = 64,
+                     n_process: int = 1,
+                     chunk_size: int = 1000) -> int:
+    """
+    Лемматизирует все тексты из базы и записывает результат обратно,
+    по одной транзакции на каждые chunk_size текстов
+    Args:
+        db: объект для работы с базой
+        nlp: spacy nlp object
+        batch_size: количество текстов в одном батче спейси
+        n_process: количество процессов (-1 - все ядра)
+        chunk_size: сколько текстов читается из базы и записывается в нее за раз
+
+    Returns: количество лемматизированных текстов
+    """
+    total = 0
+    theses_id, lemmatized = [], []
+    texts = db.iter_raw_texts(chunk_size)
+    for thesis_id, lemmas in tqdm(lemmatize_texts(texts, nlp, batch_size, n_process)):
+        theses_id.append(thesis_id)
+        lemmatized.append(lemmas)
+        if len(theses_id) >= chunk_size:
+            db.add_lemmatization(theses_id, lemmatized)
+            total += len(theses_id)
+            theses_id, lemmatized = [], []
+    if theses_id:
+        db.add_lemmatization(theses_id, lemmatized)
+        total += len(theses_id)
+    return total
+
+
+def crawl_corpus(db: DBHandler,
+                 scrapper: 'HSEVKRScrapper',
+                 vkr_pages: Iterable[str],
+                 pagelimit: int = 30,
+                 workers: int = 8,
+                 checkpoint_path: str = None,
+                 threshold: int = 100,
+                 chunk_size: int = 100) -> int:
+    """
+    Скачивает вкр со страниц образовательных программ и записывает их в базу по мере получения пачками
+    по chunk_size (одна транзакция на пачку), прогресс сохраняется после записи каждой пачки
+    (вкр с описанием короче threshold и уже имеющиеся в базе пропускаются)
+    Args:
+        db: объект для работы с базой
+        scrapper: скрэппер
+        vkr_pages: страницы с вкр образовательных программ
+        pagelimit: максимальное число страниц для каждой программы
+        workers: число потоков
+        checkpoint_path: файл с прогрессом, чтобы продолжить прерванный скрэппинг (None - без сохранения прогресса)
+        threshold: минимальная длина описания
+        chunk_size: число вкр в одной транзакции
+
+    Returns: количество добавленных вкр
+    """
+    from .crawler import CrawlCheckpoint  # requests и bs4 нужны только для скрэппинга
+
+    total = 0
+    known = db.get_theses_ids()
+    # в чекпоинте отмечены только вкр, которые уже отданы генератором, поэтому после записи пачки
+    # его можно сохранять: все отмеченные вкр либо в базе, либо пропущены
+    checkpoint = CrawlCheckpoint(checkpoint_path, autosave=False)
+    buffer = []
+
+    def flush():
+        nonlocal total
+        if buffer:
+            total += db.add_theses(buffer, chunk_size)[0]
+            buffer.clear()
+        checkpoint.save()
+
+    try:
+        for vkr_page in vkr_pages:
+            for thesis in tqdm(scrapper.iter_crawl(vkr_page, pagelimit, workers, checkpoint), desc=vkr_page):
+                if thesis.thesis_id in known or len(thesis.abstract or '') < threshold:
+                    continue
+                buffer.append(thesis)
+                known.add(thesis.thesis_id)
+                if len(buffer) >= chunk_size:
+                    flush()
+    finally:  # скачанные вкр записываются и при ошибке или остановке
+        flush()
+    return total
+
+
 def short_lines_generator(text):
     max_len = 79
     tokens = text.split()
@@ -68,7 +220,8 @@ def pprint_result(results: Iterable[tuple]):
         except UnboundLocalError:
             print(result[5])
         if result[6]:
-            print(f'ссылка на скачивание:\t{result[6]}')
+            for link in result[6].split():
+                print(f'ссылка на скачивание:\t{link}')
         print('-' * 79)
 
 
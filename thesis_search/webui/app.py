@@ -1,11 +1,13 @@
 import time
 from pathlib import Path
 
-from flask import Flask, request, render_template
+from flask import Flask, request, render_template, jsonify, Response
 
-from thesis_search import INDEX_TYPES, DATA_FOLDER, MODEL_DEFAULTS, INDEX_FOLDER
+from thesis_search import INDEX_TYPES, DATA_FOLDER, MODEL_DEFAULTS, INDEX_FOLDER, WEBUI_SETTINGS
 from thesis_search.utils.database import DBHandler
 from thesis_search.search_models.search_engine import QueryError, SearchEngine
+from thesis_search.utils.metrics import format_timings
+from thesis_search.search_models.engine_pool import EnginePool
 
 app = Flask(__name__)
 db = DBHandler(Path(DATA_FOLDER, 'theses.db'))
@@ -13,20 +15,9 @@ db = DBHandler(Path(DATA_FOLDER, 'theses.db'))
 META = {'Year': 1, 'Program': 2, 'Student': 3, 'Supervisor': 4}
 N_RESULTS = 10
 
-search_engines = {}
-for idx_type in INDEX_TYPES:
-    if idx_type in SearchEngine.downloadable:
-        SearchEngine.download_model(idx_type,
-                                    MODEL_DEFAULTS[idx_type]['model_path'],
-                                    MODEL_DEFAULTS[idx_type]['source_link'])
-    search_engines[idx_type] = SearchEngine(
-            index_type=idx_type,
-            implementation=MODEL_DEFAULTS[idx_type]['implementation'],
-            index_folder=INDEX_FOLDER,
-            data_retriever=db,
-            defaults=MODEL_DEFAULTS[idx_type],
-            preprocessor=MODEL_DEFAULTS[idx_type]['preprocessor_']
-        )
+search_engines = EnginePool(INDEX_TYPES, INDEX_FOLDER, db, MODEL_DEFAULTS)  # движки загружаются при первом запросе
+if WEBUI_SETTINGS.get('warm_up', True):
+    search_engines.warm_up()
 
 
 @app.route('/')
@@ -34,21 +25,69 @@ def home_page():
     return render_template('index.html')
 
 
+FILTERS = ('year', 'program', 'supervisor')
+
+
+def filter_values() -> dict:
+    """
+    Values of metadata fields that can be chosen in the search form
+    """
+    metadata = db.get_metadata()
+    return {field: sorted({value for _, value in metadata[field]}) for field in FILTERS}
+
+
+FILTER_VALUES = filter_values()  # метаданные собираются один раз при запуске, а не при каждой отрисовке формы
+
+
 @app.route('/search')
 def search():
-    return render_template("search.html", indices=INDEX_TYPES)
+    return render_template("search.html", indices=INDEX_TYPES, filters=FILTER_VALUES)
+
+
+@app.route('/ready')
+def ready():
+    """
+    Readiness check: 200 if at least one engine can serve queries, 503 otherwise
+    """
+    engines = search_engines.status()
+    is_ready = 'ready' in engines.values()
+    return jsonify(ready=is_ready, engines=engines), 200 if is_ready else 503
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Histograms of search stage durations by index type in the Prometheus text format
+    """
+    return Response(SearchEngine.metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/result', methods=['POST', 'GET'])
 def results():
     if request.method == 'POST':
-        idx_type = request.form['index']
+        idx_type = request.form.get('index', '')
         query = request.form['query']
+        filters = {field: request.form.getlist(field) for field in FILTERS}
+        if idx_type not in INDEX_TYPES:
+            return render_template("result.html",
+                                   query=query,
+                                   idx_type=idx_type,
+                                   error=f'неизвестный тип индекса: {idx_type}')
+        engine = search_engines.get(idx_type, wait=False)
+        if engine is None:
+            state = search_engines.status()[idx_type]
+            message = 'не удалось загрузить индекс' if state.startswith('failed') else \
+                'индекс еще загружается, попробуйте через несколько секунд'
+            return render_template("result.html",
+                                   query=query,
+                                   idx_type=idx_type,
+                                   error=message)
         try:
             start = time.time()
-            results = search_engines[idx_type].search(query, N_RESULTS)
+            timings = {}
+            results = engine.search(query, N_RESULTS, filters, timings)
             exec_time = str(round(time.time() - start, 4)) + ' s'
-        except QueryError as e:
+        except (QueryError, ValueError) as e:
             return render_template("result.html",
                                    query=query,
                                    idx_type=idx_type,
@@ -59,10 +98,11 @@ def results():
                                idx_type=idx_type,
                                n_docs=N_RESULTS,
                                time=exec_time,
+                               timings=format_timings(timings),
                                meta=META,
                                results=results)
     return render_template('index.html')
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0')
+    app.run(host='0.0.0.0', threaded=True)